@@ -4,13 +4,25 @@
 import argparse
 import random as rand
 import socket
+from functools import lru_cache
+from io import BytesIO
 from colorsys import rgb_to_hsv
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from json import dumps, loads
-from os import name, path, remove, system
+from multiprocessing import cpu_count, shared_memory
+from operator import and_, invert, or_, xor
+from os import devnull, getpid, listdir, makedirs, name, path, remove, rename, system
+from queue import Queue
+from re import findall, fullmatch, sub
 from string import ascii_lowercase, ascii_uppercase, digits
 from subprocess import run
-from urllib.parse import urlparse
+from sys import argv
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from urllib.parse import parse_qsl, urlparse
 
 
 def HasInternet(host="1.1.1.1", port=53, timeout=3):
@@ -38,11 +50,52 @@ def HasInternet(host="1.1.1.1", port=53, timeout=3):
 
 
 try:
-    from numpy import array, mgrid
-    from numpy.random import choice, shuffle
-    from PIL import Image, ImageFilter
+    from numpy import (
+        arange,
+        arctan2,
+        argsort,
+        array,
+        asarray,
+        bincount,
+        broadcast_to,
+        concatenate,
+        cos,
+        cumsum,
+        diff,
+        empty,
+        errstate,
+        float64,
+        fmax,
+        fmin,
+        full,
+        hypot,
+        indices,
+        int32,
+        int64,
+        lexsort,
+        linspace,
+        ndarray,
+        ones,
+        pi,
+        radians,
+        repeat,
+        savez,
+        searchsorted,
+        sin,
+        take_along_axis,
+        uint16,
+        uint32,
+        uint8,
+        unique,
+        where,
+        zeros,
+    )
+    from numpy import load as npload
+    from numpy.lib.format import open_memmap
+    from numpy.random import SeedSequence, default_rng
+    from PIL import Image, ImageDraw, ImageFilter
     from requests import get, post, request, put
-    from tqdm import tqdm, trange
+    from tqdm import trange
 except ImportError:
     if HasInternet():
         # Upgrade/Install all packages
@@ -58,11 +111,52 @@ except ImportError:
                 "--upgrade",
             ]
         )
-        from numpy import array, mgrid
-        from numpy.random import choice, shuffle
-        from PIL import Image, ImageFilter
+        from numpy import (
+            arange,
+            arctan2,
+            argsort,
+            array,
+            asarray,
+            bincount,
+            broadcast_to,
+            concatenate,
+            cos,
+            cumsum,
+            diff,
+            empty,
+            errstate,
+            float64,
+            fmax,
+            fmin,
+            full,
+            hypot,
+            indices,
+            int32,
+            int64,
+            lexsort,
+            linspace,
+            ndarray,
+            ones,
+            pi,
+            radians,
+            repeat,
+            savez,
+            searchsorted,
+            sin,
+            take_along_axis,
+            uint16,
+            uint32,
+            uint8,
+            unique,
+            where,
+            zeros,
+        )
+        from numpy import load as npload
+        from numpy.lib.format import open_memmap
+        from numpy.random import SeedSequence, default_rng
+        from PIL import Image, ImageDraw, ImageFilter
         from requests import get, post, request, put
-        from tqdm import tqdm, trange
+        from tqdm import trange
     else:
         print(
             "Dependecies not installed! Unable to install any automatically, script is unable to function without them."
@@ -70,28 +164,21 @@ except ImportError:
         exit()
 
 
-BlackPixel = (0, 0, 0, 255)
-WhitePixel = (255, 255, 255, 255)
-
-
 # LAMBDA FUNCTIONS #
 RemoveOld = lambda f: remove(f) if path.exists(f) else None
 Append = lambda l, obj: l.append(obj)
-AppendPIL = lambda l, x, y, d: l[y].append(d[x, y])
-Append3D = lambda l, x, y, d: l.append(d[y][x])
-AppendInPlace = lambda l, y, x: l[y].append(x)
-RandomWidth = lambda c: (c * (1 - rand.random()))
-ImgPixels = lambda i, x, y, d: i.putpixel((x, y), d[y][x])
 IDGen = lambda length: "".join(
     rand.choice(ascii_lowercase + ascii_uppercase + digits) for _ in range(length)
 )
 ProgressBars = lambda r, desc: trange(r, desc=("{:30}".format(desc)))
-AppendBW = (
-    lambda lst, x, y, data, thresh: AppendInPlace(lst, y, WhitePixel)
-    if (lightness(data[y][x]) < thresh)
-    else AppendInPlace(lst, y, BlackPixel)
+# "hue,-lightness" style inputs, every key a known sorting function with an optional "-"
+ValidSortKeys = lambda sort_input, options: all(
+    key.strip().lstrip("-") in options for key in sort_input.split(",")
 )
 
+# Separate random streams, so e.g. a different randomness does not change the intervals.
+RngStreams = {"intervals": 0, "sort": 1, "ca": 2, "snap": 3, "shuffle": 4, "paths": 5}
+
 
 # SORTING PIXELS #
 lightness = lambda p: rgb_to_hsv(p[0], p[1], p[2])[2] / 255.0
@@ -100,8 +187,68 @@ hue = lambda p: rgb_to_hsv(p[0], p[1], p[2])[0] / 255.0
 saturation = lambda p: rgb_to_hsv(p[0], p[1], p[2])[1] / 255.0
 minimum = lambda p: min(p[0], p[1], p[2])
 
+# Array forms of the sorting functions, computing the key of every pixel at once.
+KeyArrays = {
+    lightness: lambda pixels, args: HSVPlanes(pixels, args, "lightness"),
+    hue: lambda pixels, args: HSVPlanes(pixels, args, "hue"),
+    saturation: lambda pixels, args: HSVPlanes(pixels, args, "saturation"),
+    intensity: lambda pixels, args: (
+        pixels[..., 0].astype(uint16) + pixels[..., 1] + pixels[..., 2]
+    ),
+    minimum: lambda pixels, args: fmin(
+        fmin(pixels[..., 0], pixels[..., 1]), pixels[..., 2]
+    ),
+}
+
+
+# Sorting functions by name, as read from the input.
+SortingFunctions = {
+    "lightness": lightness,
+    "hue": hue,
+    "intensity": intensity,
+    "minimum": minimum,
+    "saturation": saturation,
+}
+
 
 # MISC FUNCTIONS #
+def Rng(args, stream):
+    r"""
+    Random generator for one use of randomness in a run.
+    With a seed in args every stream is reproducible, without one it is freshly seeded.
+    -----
+    :param args: Arguments.
+    :param stream: Name of the stream, a key of RngStreams.
+    :returns: numpy.random.Generator.
+
+    Example
+    -----
+    >>> widths = Rng({"seed": 7}, "intervals").random(10)
+    """
+    seed = args.get("seed")
+    return default_rng(None if seed is None else [seed, RngStreams[stream]])
+
+
+def RowRngs(args, stream, rows):
+    r"""
+    One random generator per row, for the randomness that is drawn row by row.
+    Row y of the image always gets the same stream, so strips sorted apart draw
+    exactly what the whole image would.
+    -----
+    :param args: Arguments, args["row_offset"] is the image row of the first row.
+    :param stream: Name of the stream, a key of RngStreams.
+    :param rows: number of rows.
+    :returns: list of numpy.random.Generator.
+    """
+    seed = args.get("seed")
+    entropy = SeedSequence().entropy if seed is None else seed
+    first = args.get("row_offset", 0)
+    return [
+        default_rng(SeedSequence(entropy, spawn_key=(RngStreams[stream], first + y)))
+        for y in range(rows)
+    ]
+
+
 def clear():
     r"""
     Clears the screen when called.
@@ -110,45 +257,78 @@ def clear():
     return system("cls" if name == "nt" else "clear")
 
 
-def PixelAppend(size1, size0, data, msg):
+def PixelArray(img):
     r"""
     Making a 3D array of pixel values from a PIL image.
+    The array is taken from the image buffer without copying, so it is read-only.
     -----
-    :param size1: img.size[1]/height
-    :param size0: img.size[0]/width
-    :param data: PixelAccess object from img.load()
-    :param msg: Message for the progress bar
-    :returns: 3D array of pixel values.
+    :param img: PIL Image object.
+    :returns: ndarray of shape (height, width, 4) and dtype uint8.
 
     Example
     -----
-    >>> pixels = PixelAppend(size1, size0, data, "Appending")
+    >>> pixels = PixelArray(img)
+    >>> pixels.shape
+    >>> (1974, 2560, 4)
     """
-    pixels = []
-    for y in ProgressBars(size1, msg):
-        Append(pixels, [])
-        for x in range(size0):
-            AppendPIL(pixels, x, y, data)
-    return pixels
+    return asarray(img if img.mode == "RGBA" else img.convert("RGBA"))
+
+
+def ArrayImage(pixels):
+    r"""
+    Turns a 3D array of pixel values back into a PIL image.
+    -----
+    :param pixels: ndarray of shape (height, width, 4) and dtype uint8.
+    :returns: PIL Image object.
+    """
+    return Image.fromarray(pixels, "RGBA")
+
+
+@lru_cache(maxsize=16)
+def CAMask(rulenumber, width, height, seed):
+    r"""
+    Evolves an elementary cellular automaton one whole row per step.
+    Masks are cached by (rule, width, height, seed), so batches of jobs reuse them.
+    ------
+    :param rulenumber: rule number, 0-255.
+    :param width: number of cells in a row.
+    :param height: number of generations.
+    :param seed: seed of the random first row and edge cells.
+    :returns: read-only ndarray of bools, shape (height, width).
+    """
+    rng = default_rng([seed, RngStreams["ca"], rulenumber])
+    # Lookup table from (left, middle, right) as a 3-bit number to the next state
+    rule = ((rulenumber >> arange(8)) & 1).astype(bool)
+    ca = zeros((height, width), bool)
+    # Initialize the first row randomly, cells at the edges are initialized randomly too
+    ca[0] = rng.integers(0, 2, width)
+    ca[1:, [0, -1]] = rng.integers(0, 2, (height - 1, 2))
+    for y in range(1, height):
+        prev = ca[y - 1]
+        ca[y, 1:-1] = rule[prev[:-2] * 4 + prev[1:-1] * 2 + prev[2:]]
+    ca.flags.writeable = False
+    return ca
 
 
 def ElementaryCA(pixels, args, width, height):
     r"""
     Generate images of elementary cellular automata.
     Selected rules from https://en.wikipedia.org/wiki/Elementary_cellular_automaton
+    The image stays in memory, it is kept in args["ca_image"] for uploading.
     ------
-    :param pixels: 2D list of RGB values.
+    :param pixels: ndarray of pixel values.
     :param args: namespace of arguments.
     :param width: used for image size.
     :param height: used for image size.
     :returns: PIL Image object.
     """
-    width /= 4 if width <= 2500 else 8
-    height /= 4 if height <= 2500 else 8
+    width = int(width / (4 if width <= 2500 else 8))
+    height = int(height / (4 if height <= 2500 else 8))
     if args["filelink"] in ["False", ""]:
         rules = [26, 19, 23, 25, 35, 106, 11, 110, 45, 41, 105, 54, 3, 15, 9, 154, 142]
+        rng = Rng(args, "ca")
 
-        if args["presetname"] not in ["Snap", "Random"]:
+        if args["presetname"] not in ["Snap", "Random"] and not args.get("batch"):
             ruleprompt = input(
                 f"Rule selection (max of 255)(leave blank for random)\n"
                 f"(Recommended to leave blank, most of the rules aren't good): "
@@ -158,74 +338,28 @@ def ElementaryCA(pixels, args, width, height):
                     rulenumber = int(ruleprompt)
                 else:
                     print("Number not in range, using random rule.")
-                    rulenumber = rules[rand.randrange(0, len(rules))]
+                    rulenumber = rules[rng.integers(len(rules))]
             except ValueError:
-                rulenumber = rules[rand.randrange(0, len(rules))]
+                rulenumber = rules[rng.integers(len(rules))]
         else:
-            rulenumber = rules[rand.randrange(0, len(rules))]
-
-        scalefactor = 1
-
-        # Define colors of the output image
-        true_pixel = (255, 255, 255)
-        false_pixel = (0, 0, 0)
-
-        # Generates a dictionary that tells you what your state should be based on the rule number
-        # and the states of the adjacent cells in the previous generation
-        def generate_rule(rulenumber) -> dict:
-            rule = {}
-            for left in [False, True]:
-                for middle in [False, True]:
-                    for right in [False, True]:
-                        rule[(left, middle, right)] = rulenumber % 2 == 1
-                        rulenumber //= 2
-            return rule
-
-        # Generates a 2d representation of the state of the automaton at each generation
-        def generate_ca(rule):
-            ca = []
-            # Initialize the first row of ca randomly
-            Append(ca, [])
-            for x in range(int(width)):
-                AppendInPlace(ca, 0, bool(rand.getrandbits(1)))
-
-            # Generate the succeeding generation
-            # Cells at the eges are initialized randomly
-            for y in range(1, int(height)):
-                Append(ca, [])
-                AppendInPlace(ca, y, bool(rand.getrandbits(1)))
-                for x in range(1, int(width) - 1):
-                    AppendInPlace(
-                        ca,
-                        y,
-                        (rule[(ca[y - 1][x - 1], ca[y - 1][x], ca[y - 1][x + 1])]),
-                    )
-                AppendInPlace(ca, y, bool(rand.getrandbits(1)))
-            return ca
-
-        rule = generate_rule(rulenumber)
-        ca = generate_ca(rule)
-
-        newImg = Image.new("RGB", [int(width), int(height)])
+            rulenumber = rules[rng.integers(len(rules))]
 
         print(f"Creating file image..\nRule: {rulenumber}")
-        for y in ProgressBars(int(height), "Placing pixels..."):
-            for x in range(int(width)):
-                newImg.putpixel(
-                    (x, y),
-                    true_pixel
-                    if ca[int(y / scalefactor)][int(x / scalefactor)]
-                    else false_pixel,
-                )
-
+        # unseeded runs draw a seed of their own, so they don't reuse a cached mask
+        seed = args.get("seed")
+        ca = CAMask(
+            rulenumber,
+            width,
+            height,
+            int(rng.integers(2**32)) if seed is None else seed,
+        )
+        img = Image.fromarray(ca.astype(uint8) * 255).convert("RGB")
         print("File image created!")
-        newImg.save("images/ElementaryCA.png")
-        return newImg
     else:
         print("Using file image from DB...")
         img = ImgOpen(args["filelink"], args["internet"])
-        img.save("images/ElementaryCA.png")
-        return img
+    args["ca_image"] = img
+    return img
 
 
 def UploadImg(img):
@@ -312,27 +446,6 @@ def ImgOpen(url, internet):
         exit()
 
 
-def CropTo(image_to_crop, args):
-    r"""
-    Crops image to the size of a reference image. This function assumes
-    that the relevant image is located in the center and you want to crop away
-    equal sizes on both the left and right as well on both the top and bottom.
-    :param image_to_crop
-    :param reference_image
-    :return: image cropped to the size of the reference image
-    """
-    reference_image = ImgOpen(args["url"], args["internet"])
-    reference_size = reference_image.size
-    current_size = image_to_crop.size
-    dx = current_size[0] - reference_size[0]
-    dy = current_size[1] - reference_size[1]
-    left = dx / 2
-    upper = dy / 2
-    right = dx / 2 + reference_size[0]
-    lower = dy / 2 + reference_size[1]
-    return image_to_crop.crop(box=(int(left), int(upper), int(right), int(lower)))
-
-
 def ArgParsing():
     """
     This function is purely because it is hard to minimize every arg in the main function and it reduces the complexity of the main function.
@@ -348,6 +461,14 @@ def ArgParsing():
     :-c,--clength -> character length
     :-a,--angle -> angle for rotation
     :-r,--randomness -> randomness
+    :-f,--fraction -> fraction of pixels dropped by snap
+    :-g,--path -> curve to sort along
+    :-x,--pipeline -> passes to run in order
+    :-o,--roi -> region of interest
+    :-j,--jobs -> number of processes
+    :-m,--stream -> rows per strip when streaming
+    :-w,--budget -> time budget
+    :-e,--seed -> seed
 
     //not accessible to user//
     :-l,--url -> url
@@ -395,6 +516,61 @@ def ArgParsing():
         default=10,
     )
 
+    parse.add_argument(
+        "-f",
+        "--fraction",
+        type=float,
+        help="Fraction of pixels made transparent in snap mode, between 0 and 1",
+        default=0.5,
+    )
+    parse.add_argument(
+        "-g",
+        "--path",
+        help="Sort along curves: circles, spiral[:pitch], rays, flow[:wavelength:amplitude]",
+        default=None,
+    )
+    parse.add_argument(
+        "-x",
+        "--pipeline",
+        nargs="+",
+        help="Passes run in order, e.g. vertical:threshold:lightness | horizontal:threshold:hue | snap",
+        default=None,
+    )
+    parse.add_argument(
+        "-o",
+        "--roi",
+        help="Only sort inside a region: left,top,right,bottom or x,y;x,y;x,y;... or a mask image",
+        default=None,
+    )
+    parse.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of processes sorting row strips, 0 for one per core",
+        default=1,
+    )
+    parse.add_argument(
+        "-m",
+        "--stream",
+        type=int,
+        help="Sort in strips of this many rows, see the stream command for huge images",
+        default=0,
+    )
+    parse.add_argument(
+        "-w",
+        "--budget",
+        type=float,
+        help="Time budget in seconds, images estimated to take longer are sorted smaller",
+        default=0,
+    )
+    parse.add_argument(
+        "-e",
+        "--seed",
+        type=int,
+        help="Seed for every random choice, makes a run reproducible",
+        default=None,
+    )
+
     parse_util.add_argument(
         "-l",
         "--url",
@@ -404,13 +580,14 @@ def ArgParsing():
     parse_util.add_argument(
         "-i",
         "--int_function",
-        help="random, threshold, edges, waves, snap, shuffle-total, shuffle-axis, file, file-edges, none",
-        default="random",
+        nargs="+",
+        help="random, threshold, edges, waves, snap, shuffle-total, shuffle-axis, file, file-edges, none, or a combination like threshold & ~edges",
+        default=["random"],
     )
     parse_util.add_argument(
         "-s",
         "--sorting_function",
-        help="lightness, intensity, hue, saturation, minimum",
+        help="lightness, intensity, hue, saturation, minimum, or several separated by commas, '-' for descending",
         default="lightness",
     )
     parse_util.add_argument(
@@ -444,12 +621,12 @@ def ArgParsing():
 
 
 # READING FUNCTIONS #
-def ReadImageInput(url_input, misc_variables, internet=HasInternet()):
+def ReadImageInput(url_input, misc_variables, internet=None):
     r"""
     Reading the image input.
     -----
     :param url_input: The inputted URL, number of default image, or local file path.
-    :param internet: true/false for having internet.
+    :param internet: true/false for having internet, checked if not given.
     :returns: (in order) url[str], url_given[bool], url_random[bool], random_url[str]
 
     Explination on returns:
@@ -459,6 +636,8 @@ def ReadImageInput(url_input, misc_variables, internet=HasInternet()):
     - random_url -> if the url was randomly chose, the string of what number was chosen
     """
     print("Opening image...")
+    # checked here rather than as the default, which would run on every import
+    internet = HasInternet() if internet is None else internet
     url_options = {
         "0": "https://s.put.re/SRcqAfhP.jpg",
         "1": "https://s.put.re/Ds9KV8jX.jpg",
@@ -545,7 +724,71 @@ def ReadIntervalFunction(int_func_input):
             "none": none,
         }[int_func_input]
     except KeyError:
-        return random
+        tree = ReadMaskExpression(int_func_input)
+        return CombinedIntervals(tree) if tree else random
+
+
+def ReadMaskExpression(expression):
+    r"""
+    Reading a combination of interval functions, e.g. "threshold & ~edges".
+    Operators are & | ^ ~ or the words and, or, xor, not, with parentheses for grouping.
+    ~ binds tightest, then &, then ^, then |.
+    -----
+    :param expression: A (lowercase) string.
+    :returns: tree of tuples, ("mask", name) or (operator, operand, ...), or None if invalid.
+
+    Example
+    -----
+    >>> ReadMaskExpression("threshold and not edges")
+    >>> (and_, ('mask', 'threshold'), (invert, ('mask', 'edges')))
+    """
+    if not fullmatch(r"(\s*([()&|^~]|[a-z][a-z-]*))*\s*", expression):
+        return None
+    words = {"and": "&", "or": "|", "xor": "^", "not": "~"}
+    tokens = [
+        words.get(token, token)
+        for token in findall(r"[()&|^~]|[a-z][a-z-]*", expression)
+    ]
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def binary(symbol, operator, operand):
+        tree = operand()
+        while peek() == symbol:
+            take()
+            tree = (operator, tree, operand())
+        return tree
+
+    def unary():
+        token = take() if peek() else None
+        if token == "~":
+            return (invert, unary())
+        if token == "(":
+            tree = either()
+            if take() != ")":
+                raise ValueError
+            return tree
+        if token not in MaskNames:
+            raise ValueError
+        return ("mask", token)
+
+    def either():
+        return binary(
+            "|", or_, lambda: binary("^", xor, lambda: binary("&", and_, unary))
+        )
+
+    try:
+        tree = either()
+    except (ValueError, IndexError):
+        return None
+    return tree if peek() is None else None
 
 
 def ReadSortingFunction(sort_func_input):
@@ -561,19 +804,58 @@ def ReadSortingFunction(sort_func_input):
     >>> sortFunc = ReadSortingFunction("hue")
     >>> sortFunc
     >>> lambda<hue>
+
+    Several keys separated by commas make a composite key, sorted on the first key and
+    ties broken by the next. A leading "-" sorts that key descending.
+    >>> ReadSortingFunction("hue,-lightness")
+    >>> ((lambda<hue>, False), (lambda<lightness>, True))
     """
+    if "," in sort_func_input or sort_func_input.startswith("-"):
+        return tuple(
+            (
+                SortingFunctions.get(key.strip().lstrip("-"), lightness),
+                key.strip()[:1] == "-",
+            )
+            for key in sort_func_input.split(",")
+            if key.strip()
+        )
     try:
-        return {
-            "lightness": lightness,
-            "hue": hue,
-            "intensity": intensity,
-            "minimum": minimum,
-            "saturation": saturation,
-        }[sort_func_input]
+        return SortingFunctions[sort_func_input]
     except KeyError:
         return lightness
 
 
+def ReadPipeline(pipeline_input):
+    r"""
+    Reading a pipeline of passes given with -x.
+    -----
+    :param pipeline_input: passes separated by "|", each "[axis:]interval[:sorting]".
+    :returns: list of (axis[str], interval function, sorting function).
+
+    Example
+    -----
+    >>> ReadPipeline("vertical:threshold:lightness | horizontal:threshold:hue | snap")
+    >>> [('vertical', function<threshold>, lambda<lightness>), ...]
+    """
+    passes = []
+    for step in pipeline_input.lower().split("|"):
+        parts = [part.strip() for part in step.split(":") if part.strip()]
+        if not parts:
+            continue
+        axis = parts.pop(0) if parts[0] in ["horizontal", "vertical"] else "horizontal"
+        int_func_input = parts[0] if parts else "random"
+        sort_func_input = parts[1] if len(parts) > 1 else "lightness"
+        Append(
+            passes,
+            (
+                axis,
+                ReadIntervalFunction(int_func_input),
+                ReadSortingFunction(sort_func_input),
+            ),
+        )
+    return passes
+
+
 def ReadPreset(preset_input, width, presets):
     r"""
     Returning values for 'presets'.
@@ -658,266 +940,2034 @@ def ReadPreset(preset_input, width, presets):
         )
 
 
-# SORTER #
-def SortImage(pixels, intervals, args, sorting_function):
+# SORTER #
+def PlaneCache(pixels, args):
+    r"""
+    Returns the planes already computed from these pixels during this run.
+    The cache is kept in args and starts over whenever a different pixel buffer is passed.
+    -----
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
+    :param args: Arguments.
+    :returns: dict of cached planes.
+    """
+    cache = args.get("planes")
+    if cache is None or cache["pixels"] is not pixels:
+        cache = args["planes"] = {"pixels": pixels}
+    return cache
+
+
+def HSVPlanes(pixels, args, channel):
+    r"""
+    Computes a hue, saturation or lightness plane of the image.
+    Follows colorsys.rgb_to_hsv step by step so the results match the scalar lambdas.
+    Hue and saturation are computed together, lightness only needs the maximum channel.
+    -----
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
+    :param args: Arguments.
+    :param channel: "hue", "saturation" or "lightness".
+    :returns: ndarray of float64, shape (height, width).
+    """
+    cache = PlaneCache(pixels, args)
+    if channel in cache:
+        return cache[channel]
+    top = fmax(fmax(pixels[..., 0], pixels[..., 1]), pixels[..., 2])
+    cache["lightness"] = top / 255.0
+    if channel != "lightness":
+        r, g, b = (pixels[..., i].astype(float64) for i in range(3))
+        maxc = top.astype(float64)
+        rangec = maxc - fmin(fmin(pixels[..., 0], pixels[..., 1]), pixels[..., 2])
+        grey = rangec == 0
+        with errstate(divide="ignore", invalid="ignore"):
+            s = where(grey, 0.0, rangec / maxc)
+            rc = (maxc - r) / rangec
+            gc = (maxc - g) / rangec
+            bc = (maxc - b) / rangec
+        h = where(r == maxc, bc - gc, where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+        h = where(grey, 0.0, (h / 6.0) % 1.0)
+        cache["hue"] = h / 255.0
+        cache["saturation"] = s / 255.0
+    return cache[channel]
+
+
+def KeyPlane(pixels, sorting_function, args):
+    r"""
+    Computes the sort key of every pixel at once.
+    Sorting functions without an array form are called once per distinct colour.
+    -----
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
+    :param sorting_function: Sorting function used in sorting of pixels.
+    :param args: Arguments.
+    :returns: ndarray of keys, shape (height, width).
+    """
+    cache = PlaneCache(pixels, args)
+    if sorting_function not in cache:
+        if sorting_function in KeyArrays:
+            cache[sorting_function] = KeyArrays[sorting_function](pixels, args)
+        else:
+            rgb = (
+                pixels[..., 0].astype(uint32) << 16
+                | pixels[..., 1].astype(uint32) << 8
+                | pixels[..., 2]
+            )
+            colours, inverse = unique(rgb, return_inverse=True)
+            keys = array(
+                [
+                    sorting_function((c >> 16, (c >> 8) & 255, c & 255))
+                    for c in colours.tolist()
+                ]
+            )
+            cache[sorting_function] = keys[inverse].reshape(rgb.shape)
+    return cache[sorting_function]
+
+
+def KeyPlanes(pixels, sorting_function, args):
+    r"""
+    Computes the key planes of a sorting function, most significant key first.
+    Descending keys are negated, so every plane is sorted ascending.
+    -----
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
+    :param sorting_function: Sorting function, or a tuple of (sorting function, descending) pairs.
+    :param args: Arguments.
+    :returns: list of ndarrays of keys, shape (height, width).
+    """
+    if not isinstance(sorting_function, tuple):
+        return [KeyPlane(pixels, sorting_function, args)]
+    planes = []
+    for function, descending in sorting_function:
+        keys = KeyPlane(pixels, function, args)
+        if descending:
+            keys = -(keys.astype(int32) if keys.dtype.kind == "u" else keys)
+        Append(planes, keys)
+    return planes
+
+
+def SegmentIds(intervals, width):
+    r"""
+    Labels every pixel with the index of the interval it is in.
+    Intervals are numbered in row order, so the labels never decrease along the image.
+    -----
+    :param intervals: Intervals of every row.
+    :param width: width of the image.
+    :returns: (in order) ndarray of labels, shape (height * width,), and the number of intervals.
+    """
+    bounds = intervals.flat(width)
+    size = len(intervals) * width
+    starts = bincount(bounds[bounds < size], minlength=size)
+    return cumsum(starts), len(bounds) + 1
+
+
+def RadixSort(keys, labels):
+    r"""
+    Stable LSD radix sort of every row on (interval label, key).
+    Every pass is a stable counting sort over 16-bit values, so the sort runs in linear time.
+    -----
+    :param keys: ndarray of uint16 keys, shape (rows, width).
+    :param labels: ndarray of interval labels counted from the start of each row.
+    :returns: ndarray of indices that sorts the pixels.
+    """
+    order = argsort(keys, axis=1, kind="stable")
+    labels = take_along_axis(labels, order, axis=1)
+    top = int(labels.max())
+    shift = 0
+    while top >> shift:
+        digit = ((labels >> shift) & 0xFFFF).astype(uint16)
+        step = argsort(digit, axis=1, kind="stable")
+        order = take_along_axis(order, step, axis=1)
+        labels = take_along_axis(labels, step, axis=1)
+        shift += 16
+    return (order + arange(0, keys.size, keys.shape[1])[:, None]).ravel()
+
+
+def SortMask(intervals, count, args):
+    r"""
+    Draws which intervals get sorted, each row from its own stream.
+    -----
+    :param intervals: Intervals of every row.
+    :param count: number of interval labels, from SegmentIds.
+    :param args: Arguments.
+    :returns: ndarray of bools, one per interval label, False for intervals left as they are.
+    """
+    draws = zeros(count, int64)
+    draws[: len(intervals.bounds)] = concatenate(
+        [
+            rng.integers(0, 101, size)
+            for rng, size in zip(
+                RowRngs(args, "sort", len(intervals)), diff(intervals.offsets)
+            )
+        ]
+    )
+    return draws >= args["randomness"]
+
+
+def SegmentSort(planes, segments, sort_mask):
+    r"""
+    Sorts every interval of the image in one stable pass.
+    A single integer key with a range below 2 ** 16 (intensity, minimum) takes the linear
+    radix path, everything else, composite keys included, is one lexsort.
+    -----
+    :param planes: list of ndarrays of keys, most significant first, shape (height, width) or one flat row.
+    :param segments: ndarray of interval labels, one per pixel, never decreasing.
+    :param sort_mask: ndarray of bools, one per interval, False for intervals left as they are.
+    :returns: ndarray of indices that sorts the pixels.
+    """
+    skip = ~sort_mask[segments]
+    if len(planes) > 1:
+        return lexsort(
+            (*(where(skip, 0, keys.ravel()) for keys in planes[::-1]), segments)
+        )
+    keys = planes[0].reshape(-1, planes[0].shape[-1])
+    keys = where(skip.reshape(keys.shape), 0, keys)
+    if keys.dtype.kind in "ui" and keys.size:
+        low = int(keys.min())
+        if int(keys.max()) - low < 1 << 16:
+            labels = segments.reshape(keys.shape)
+            return RadixSort((keys - low).astype(uint16), labels - labels[:, :1])
+    return lexsort((keys.ravel(), segments))
+
+
+def SortImage(pixels, intervals, args, sorting_function, inside=None):
+    r"""
+    Sorts the image.
+    -----
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
+    :param intervals: Intervals from the selected interval function.
+    :param args: Arguments.
+    :param sorting_function: Sorting function used in sorting of pixels.
+    :param inside: ndarray of bools, shape (height, width), the pixels allowed to move. All by default.
+    :returns: ndarray of sorted pixels, same shape as pixels.
+    """
+    if inside is not None:
+        intervals = Intervals.from_mask(
+            intervals.to_mask(pixels.shape[1]) | RunStarts(inside)
+        )
+    segments, count = SegmentIds(intervals, pixels.shape[1])
+    sort_mask = SortMask(intervals, count, args)
+    if inside is not None:
+        sort_mask[segments[~inside.ravel()]] = False
+    planes = KeyPlanes(pixels, sorting_function, args)
+    order = SegmentSort(planes, segments, sort_mask)
+    return pixels.reshape(-1, 4)[order].reshape(pixels.shape)
+
+
+# PATHS #
+class Paths:
+    r"""
+    Precomputed paths through an image, so pixels can be sorted along lines or curves
+    without rotating or resampling the image.
+    Pixel index[i] of the flattened image goes to position pos[i] of a (rows, width) buffer,
+    every buffer row holding one path. Positions of a path are consecutive and sorted along it.
+    -----
+    :param path: ndarray of path ids, one per pixel, shape (height, width).
+    :param along: ndarray of positions along the paths, one per pixel.
+    :param aligned: start each path at its first position (in pixels) instead of at 0,
+        so neighbouring paths line up in the buffer.
+    """
+
+    def __init__(self, path, along, aligned=False):
+        size = path.size
+        dtype = int32 if size < 1 << 31 else int64
+        path = unique(path.ravel(), return_inverse=True)[1].ravel()
+        along = along.ravel()
+        order = lexsort((along, path))
+        path = path[order]
+        counts = bincount(path)
+        firsts = concatenate(([0], cumsum(counts)[:-1]))
+        starts = zeros(len(counts), int64)
+        if aligned:
+            starts = (along[order][firsts] - along.min()).round().astype(int64)
+        column = arange(size) - repeat(firsts - starts, counts)
+        self.rows = len(counts)
+        self.width = int(column.max()) + 1
+        self.index = order.astype(dtype)
+        self.pos = (path * self.width + column).astype(dtype)
+        self.limits = zeros((self.rows, self.width), bool)
+        self.limits[arange(self.rows), starts] = True
+        ends = starts + counts
+        inside = (ends < self.width).nonzero()[0]
+        self.limits[inside, ends[inside]] = True
+        self.index.flags.writeable = False
+        self.pos.flags.writeable = False
+        self.limits.flags.writeable = False
+
+    def gather(self, pixels):
+        r"""
+        Copies the pixels into the path buffer, padding with transparent pixels.
+        """
+        buffer = zeros((self.rows * self.width, 4), uint8)
+        buffer[self.pos] = pixels.reshape(-1, 4)[self.index]
+        return buffer.reshape(self.rows, self.width, 4)
+
+
+# Paths take about 10 bytes per pixel, so long-lived batch and serve workers keep only a few.
+@lru_cache(maxsize=2)
+def LinePaths(angle, width, height):
+    r"""
+    Parallel lines through an image at an angle, cached by (angle, size).
+    The lines run the way rows of the image would after Image.rotate(angle, expand=True).
+    -----
+    :param angle: angle in degrees.
+    :param width: width of the image.
+    :param height: height of the image.
+    :returns: Paths.
+    """
+    theta = radians(angle)
+    y, x = indices((height, width), dtype=float64)
+    across = y * cos(theta) - x * sin(theta)
+    along = x * cos(theta) + y * sin(theta)
+    return Paths(across.round().astype(int64), along, aligned=True)
+
+
+@lru_cache(maxsize=2)
+def CurvePaths(kind, width, height, params, angle, seed):
+    r"""
+    Curves through an image, cached by (kind, size, params, angle, seed).
+    - circles: concentric circles around the centre, sorted clockwise.
+    - spiral: an Archimedean spiral around the centre, params (pitch,), sorted outwards.
+    - rays: straight rays from the centre, sorted outwards.
+    - flow: streamlines of a wavy flow at the given angle, params (wavelength, amplitude).
+    -----
+    :param kind: "circles", "spiral", "rays" or "flow".
+    :param width: width of the image.
+    :param height: height of the image.
+    :param params: tuple of floats, empty for the defaults.
+    :param angle: angle in degrees, only used by flow.
+    :param seed: seed of the flow's phases, None for fixed phases.
+    :returns: Paths.
+    """
+    y, x = indices((height, width), dtype=float64)
+    x -= (width - 1) / 2
+    y -= (height - 1) / 2
+    radius = hypot(x, y)
+    theta = arctan2(y, x) % (2 * pi)
+    if kind == "circles":
+        return Paths(radius.round().astype(int64), theta)
+    if kind == "spiral":
+        pitch = params[0] if params else 20.0
+        arm = (radius - pitch * theta / (2 * pi)) % pitch
+        return Paths(arm.round().astype(int64) % max(int(round(pitch)), 1), radius)
+    if kind == "rays":
+        count = max(int(2 * pi * radius.max()), 1)
+        return Paths((theta / (2 * pi) * count).round().astype(int64) % count, radius)
+    wavelength, amplitude = (tuple(params) + (120.0, 30.0)[len(params) :])[:2]
+    phases = (
+        zeros(2)
+        if seed is None
+        else default_rng([seed, RngStreams["paths"]]).random(2) * 2 * pi
+    )
+    along = x * cos(radians(angle)) + y * sin(radians(angle))
+    across = y * cos(radians(angle)) - x * sin(radians(angle))
+    stream = (
+        across
+        + amplitude * sin(2 * pi * along / wavelength + phases[0])
+        + amplitude / 2 * sin(4 * pi * along / wavelength + phases[1])
+    )
+    return Paths(stream.round().astype(int64), along, aligned=True)
+
+
+def ReadPath(path_input):
+    r"""
+    Reading the path spec given with -g.
+    -----
+    :param path_input: "kind" or "kind:param:param", e.g. "spiral:30".
+    :returns: (in order) kind[str], params[tuple], or None if no valid path was given.
+
+    Example
+    -----
+    >>> ReadPath("flow:80:20")
+    >>> ('flow', (80.0, 20.0))
+    """
+    if not path_input:
+        return None
+    kind, *params = path_input.lower().split(":")
+    if kind not in ["circles", "spiral", "rays", "flow"]:
+        print(f"[WARNING] Unknown path '{kind}', sorting along straight lines")
+        return None
+    try:
+        return kind, tuple(float(param) for param in params if param)
+    except ValueError:
+        print(f"[WARNING] Invalid path parameters '{path_input}', using defaults")
+        return kind, ()
+
+
+def SortPaths(pixels, paths, interval_function, sorting_function, args, inside=None):
+    r"""
+    Sorts the image along precomputed paths.
+    The paths are gathered into a buffer for the interval function, then only the real pixels
+    are keyed, sorted and scattered back in place.
+    -----
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
+    :param paths: Paths through the image.
+    :param interval_function: Interval function run on the path buffer.
+    :param sorting_function: Sorting function used in sorting of pixels.
+    :param args: Arguments.
+    :param inside: ndarray of bools, shape (height, width), the pixels allowed to move. All by default.
+    :returns: ndarray of sorted pixels, same shape as pixels.
+    """
+    buffer = paths.gather(pixels)
+    intervals = interval_function(buffer, args)
+    CheckDeadline(args, "sorting")
+    limits = intervals.to_mask(paths.width) | paths.limits
+    if inside is not None:
+        along = zeros(paths.rows * paths.width, bool)
+        along[paths.pos] = inside.ravel()[paths.index]
+        limits |= RunStarts(along.reshape(paths.rows, paths.width))
+    intervals = Intervals.from_mask(limits)
+    print("Sorting...")
+    segments, count = SegmentIds(intervals, paths.width)
+    sort_mask = SortMask(intervals, count, args)
+    if inside is not None:
+        sort_mask[segments[paths.pos][~along[paths.pos]]] = False
+    # keys of the real pixels only, in path order, cached like those of straight sorts
+    planes = [
+        keys.ravel()[paths.index] for keys in KeyPlanes(pixels, sorting_function, args)
+    ]
+    order = SegmentSort(planes, segments[paths.pos], sort_mask)
+    sorted_pixels = empty((pixels.shape[0] * pixels.shape[1], 4), uint8)
+    sorted_pixels[paths.index] = pixels.reshape(-1, 4)[paths.index[order]]
+    return sorted_pixels.reshape(pixels.shape)
+
+
+def SortPass(pixels, args, interval_function, sorting_function):
+    r"""
+    Runs one interval function and sort over the image at args["angle"] degrees.
+    Angles other than 0 sort along cached parallel lines instead of rotating the image,
+    a path from -g sorts along cached curves.
+    With a region from -o only its bounding box is read and sorted, the rest is copied as is.
+    -----
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
+    :param args: Arguments.
+    :param interval_function: Interval function.
+    :param sorting_function: Sorting function used in sorting of pixels.
+    :returns: ndarray of sorted pixels, same shape as pixels.
+    """
+    if not args.get("roi"):
+        return SortBox(pixels, args, interval_function, sorting_function)
+    height, width = pixels.shape[:2]
+    # vertical pipeline passes sort a transposed view, the region is given untransposed
+    transposed = args.get("axis") == "vertical"
+    region = ReadRegion(
+        args["roi"], *((height, width) if transposed else (width, height))
+    )
+    if region is None:
+        return SortBox(pixels, args, interval_function, sorting_function)
+    (top, bottom, left, right), inside = region
+    if transposed:
+        (top, bottom, left, right), inside = (left, right, top, bottom), (
+            None if inside is None else inside.T
+        )
+    pixels_return = pixels.copy()
+    pixels_return[top:bottom, left:right] = SortBox(
+        pixels[top:bottom, left:right],
+        args,
+        interval_function,
+        sorting_function,
+        inside,
+    )
+    return pixels_return
+
+
+def SortBox(pixels, args, interval_function, sorting_function, inside=None):
+    r"""
+    Sorts the whole of pixels straight, at an angle or along a curve, see SortPass.
+    -----
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
+    :param args: Arguments.
+    :param interval_function: Interval function.
+    :param sorting_function: Sorting function used in sorting of pixels.
+    :param inside: ndarray of bools, shape (height, width), the pixels allowed to move. All by default.
+    :returns: ndarray of sorted pixels, same shape as pixels.
+    """
+    height, width = pixels.shape[:2]
+    angle = args["angle"] % 360
+    curve = ReadPath(args.get("path"))
+    if (
+        (args.get("jobs") or 1) != 1
+        and not curve
+        and not angle
+        and inside is None
+        and interval_function.__name__ in RowFunctions
+        and SortInput(sorting_function)
+    ):
+        return ParallelSort(pixels, args, interval_function, sorting_function)
+    if curve:
+        kind, params = curve
+        bend = angle if kind == "flow" else 0
+        paths = CurvePaths(kind, width, height, params, bend, args.get("seed"))
+    elif angle:
+        paths = LinePaths(angle, width, height)
+    else:
+        intervals = interval_function(pixels, args)
+        CheckDeadline(args, "sorting")
+        print("Sorting...")
+        return SortImage(pixels, intervals, args, sorting_function, inside)
+    return SortPaths(pixels, paths, interval_function, sorting_function, args, inside)
+
+
+def RunPipeline(pixels, passes, args):
+    r"""
+    Runs every pass of a pipeline on one buffer in memory.
+    Vertical passes sort a transposed view of the buffer, so no pass copies or rotates the image.
+    -----
+    :param pixels: ndarray (height, width, 4).
+    :param passes: list from ReadPipeline.
+    :param args: Arguments given.
+    :returns: ndarray (height, width, 4).
+    """
+    buffer = pixels.copy()
+    for count, (axis, interval_function, sorting_function) in enumerate(passes, 1):
+        CheckDeadline(args, f"pass {count}")
+        print(f"Pass {count}/{len(passes)}: {axis} {interval_function.__name__}")
+        # a fresh view per pass, as cached planes are keyed by the pixels object
+        view = buffer.transpose(1, 0, 2) if axis == "vertical" else buffer[...]
+        args["axis"] = axis
+        if interval_function is snap_sort:
+            view[...] = snap_sort(
+                SortPass(view, args, file_edges, sorting_function), args
+            )
+        elif interval_function in [shuffle_total, shuffled_axis]:
+            view[...] = interval_function(view, args)
+        else:
+            view[...] = SortPass(view, args, interval_function, sorting_function)
+    args["axis"] = None
+    return buffer
+
+
+# PARALLEL #
+# Interval functions that only look at one row at a time, so rows can be sorted apart.
+RowFunctions = ["threshold", "random", "waves", "none"]
+
+
+def SortInput(sorting_function):
+    r"""
+    The input string that reads back as this sorting function, to hand it to another process.
+    -----
+    :param sorting_function: Sorting function, or a tuple of (sorting function, descending) pairs.
+    :returns: str, or None for sorting functions that can't be read back.
+    """
+    names = {function: name for name, function in SortingFunctions.items()}
+    keys = (
+        sorting_function
+        if isinstance(sorting_function, tuple)
+        else ((sorting_function, False),)
+    )
+    if not all(function in names for function, descending in keys):
+        return None
+    return ",".join(("-" if descending else "") + names[f] for f, descending in keys)
+
+
+def SortStrip(name, shape, start, stop, int_func_input, sort_func_input, args):
+    r"""
+    Sorts rows start to stop of an image in shared memory, in place.
+    Runs in a worker process of ParallelSort.
+    -----
+    :param name: name of the shared memory block.
+    :param shape: shape of the image.
+    :param start: first row of the strip.
+    :param stop: row after the last row of the strip.
+    :param int_func_input: name of the interval function.
+    :param sort_func_input: sorting function input, from SortInput.
+    :param args: Arguments.
+    """
+    CheckDeadline(args, f"rows {start}-{stop}")
+    memory = shared_memory.SharedMemory(name=name)
+    strip = ndarray(shape, uint8, memory.buf)[start:stop]
+    args = dict(args, row_offset=start)
+    strip[...] = SortImage(
+        strip,
+        ReadIntervalFunction(int_func_input)(strip, args),
+        args,
+        ReadSortingFunction(sort_func_input),
+    )
+    del strip
+    memory.close()
+
+
+def ParallelSort(pixels, args, interval_function, sorting_function):
+    r"""
+    Sorts row strips of the image in args["jobs"] processes, 0 meaning one per core.
+    The image is shared with the workers instead of copied to each. Random draws come from
+    per row streams, so the output is the same for any number of jobs.
+    -----
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
+    :param args: Arguments.
+    :param interval_function: Interval function, one of RowFunctions.
+    :param sorting_function: Sorting function used in sorting of pixels.
+    :returns: ndarray of sorted pixels, same shape as pixels.
+    """
+    jobs = args["jobs"] if args["jobs"] > 0 else cpu_count()
+    height = len(pixels)
+    # workers get the arguments without cached planes, sharing one seed for the row streams
+    worker_args = {
+        key: value for key, value in args.items() if key not in ["planes", "ca_image"]
+    }
+    if worker_args.get("seed") is None:
+        worker_args["seed"] = SeedSequence().entropy
+    bounds = linspace(0, height, min(jobs * 4, height) + 1).astype(int64).tolist()
+    print(f"Sorting in {jobs} processes...")
+    memory = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+    try:
+        shared = ndarray(pixels.shape, uint8, memory.buf)
+        shared[...] = pixels
+        with ProcessPoolExecutor(jobs) as pool:
+            strips = [
+                pool.submit(
+                    SortStrip,
+                    memory.name,
+                    pixels.shape,
+                    start,
+                    stop,
+                    interval_function.__name__,
+                    SortInput(sorting_function),
+                    worker_args,
+                )
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            ]
+            for strip in strips:
+                strip.result()
+        pixels_return = shared.copy()
+        del shared
+    finally:
+        memory.close()
+        memory.unlink()
+    return pixels_return
+
+
+# STREAMING #
+def ReadStrip(source, top, bottom):
+    r"""
+    Reads rows top to bottom of an image as RGBA pixels.
+    -----
+    :param source: PIL Image, or an ndarray (height, width, 3 or 4), e.g. a memmapped .npy file.
+    :param top: first row.
+    :param bottom: row after the last row.
+    :returns: ndarray (bottom - top, width, 4).
+    """
+    if isinstance(source, Image.Image):
+        return PixelArray(source.crop((0, top, source.width, bottom)))
+    strip = asarray(source[top:bottom], dtype=uint8)
+    if strip.shape[2] == 3:
+        strip = concatenate((strip, full(strip.shape[:2] + (1,), 255, uint8)), axis=2)
+    return strip
+
+
+def StreamSort(source, output_path, args, interval_function, sorting_function):
+    r"""
+    Sorts the image horizontally strip by strip, writing every strip to a .npy file.
+    Only one strip of args["stream"] rows is in memory at a time, besides the source
+    and, without an output path, the sorted image.
+    Rows draw from their own random streams, so the output is the same as sorting
+    the whole image at once.
+    -----
+    :param source: PIL Image, or an ndarray (height, width, 3 or 4), e.g. a memmapped .npy file.
+    :param output_path: path of the .npy file written, None to sort into memory.
+    :param args: Arguments.
+    :param interval_function: Interval function, one of RowFunctions.
+    :param sorting_function: Sorting function used in sorting of pixels.
+    :returns: ndarray of sorted pixels, shape (height, width, 4), memmapped with an output path.
+    """
+    height, width = (
+        (source.height, source.width)
+        if isinstance(source, Image.Image)
+        else source.shape[:2]
+    )
+    rows = max(args["stream"], 1)
+    output = (
+        empty((height, width, 4), uint8)
+        if output_path is None
+        else open_memmap(output_path, mode="w+", dtype=uint8, shape=(height, width, 4))
+    )
+    for strip_index in ProgressBars(-(-height // rows), "Sorting strips..."):
+        top = strip_index * rows
+        CheckDeadline(args, f"rows {top}-{min(top + rows, height)}")
+        strip = ReadStrip(source, top, min(top + rows, height))
+        args["row_offset"] = top
+        output[top : top + rows] = SortImage(
+            strip, interval_function(strip, args), args, sorting_function
+        )
+    args["row_offset"] = 0
+    if output_path is not None:
+        output.flush()
+        print(f"Raw output saved as {output_path}")
+    return output
+
+
+# REGIONS #
+def RunStarts(inside):
+    r"""
+    Marks where every run of inside or outside pixels starts along the rows.
+    -----
+    :param inside: ndarray of bools, shape (height, width).
+    :returns: ndarray of bools, same shape as inside.
+    """
+    starts = zeros(inside.shape, bool)
+    starts[:, 1:] = inside[:, 1:] != inside[:, :-1]
+    return starts
+
+
+@lru_cache(maxsize=8)
+def ReadRegion(roi_input, width, height):
+    r"""
+    Reading the region of interest given with -o, clipped to the image.
+    -----
+    :param roi_input: "left,top,right,bottom" for a rectangle, "x,y;x,y;x,y;..." for a polygon,
+        or the path of a mask image, white inside.
+    :param width: width of the image.
+    :param height: height of the image.
+    :returns: (in order) box[tuple of top, bottom, left, right], inside[ndarray of bools over the box,
+        None for rectangles], or None if the region is invalid or empty.
+
+    Example
+    -----
+    >>> ReadRegion("10,20,110,220", 1920, 1080)
+    >>> ((20, 220, 10, 110), None)
+    """
+    clip = lambda box: (
+        max(int(box[1]), 0),
+        min(int(box[3]), height),
+        max(int(box[0]), 0),
+        min(int(box[2]), width),
+    )
+    try:
+        if path.isfile(roi_input):
+            mask = Image.open(roi_input).convert("L")
+            if mask.size != (width, height):
+                mask = mask.resize((width, height), Image.NEAREST)
+            box = mask.point(lambda value: 255 if value > 127 else 0).getbbox()
+            if box is None:
+                raise ValueError
+            top, bottom, left, right = clip(box)
+            inside = asarray(mask.crop((left, top, right, bottom))) > 127
+        else:
+            points = [
+                tuple(float(value) for value in point.split(","))
+                for point in roi_input.split(";")
+            ]
+            if len(points) == 1 and len(points[0]) == 4:
+                (left, top, right, bottom), inside = points[0], None
+                top, bottom, left, right = clip((left, top, right, bottom))
+            elif len(points) >= 3 and all(len(point) == 2 for point in points):
+                xs, ys = [x for x, y in points], [y for x, y in points]
+                top, bottom, left, right = clip(
+                    (min(xs), min(ys), max(xs) + 1, max(ys) + 1)
+                )
+                mask = Image.new("L", (max(right - left, 1), max(bottom - top, 1)))
+                ImageDraw.Draw(mask).polygon(
+                    [(x - left, y - top) for x, y in points], fill=255
+                )
+                inside = asarray(mask) > 0
+            else:
+                raise ValueError
+        if bottom <= top or right <= left:
+            raise ValueError
+    except (ValueError, OSError):
+        print(
+            f"[WARNING] Invalid or empty region '{roi_input}', sorting the whole image"
+        )
+        return None
+    if inside is not None:
+        inside.flags.writeable = False
+    return (top, bottom, left, right), inside
+
+
+# INTERVALS #
+class Intervals:
+    r"""
+    Interval boundaries of every row, stored as compressed sparse rows.
+    Row y ends its intervals at bounds[offsets[y]:offsets[y + 1]], the last one being the row width.
+    -----
+    :param offsets: ndarray of row offsets into bounds, shape (height + 1,).
+    :param bounds: ndarray of int32 boundaries.
+
+    Example
+    -----
+    >>> intervals = Intervals.from_mask(array([[0, 0, 0, 1, 0, 0, 0, 1, 0, 0]], bool))
+    >>> intervals[0]
+    >>> array([ 3,  7, 10], dtype=int32)
+    """
+
+    def __init__(self, offsets, bounds):
+        self.offsets = asarray(offsets, dtype=int64)
+        self.bounds = asarray(bounds, dtype=int32)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, y):
+        return self.bounds[self.offsets[y] : self.offsets[y + 1]]
+
+    @classmethod
+    def from_mask(cls, mask):
+        r"""
+        Builds intervals from a boolean (height, width) mask that is True where a new interval starts.
+        """
+        height = mask.shape[0]
+        rows, bounds = concatenate((mask, ones((height, 1), bool)), axis=1).nonzero()
+        return cls(concatenate(([0], cumsum(bincount(rows, minlength=height)))), bounds)
+
+    def to_mask(self, width):
+        r"""
+        Returns the boolean (height, width) mask that is True where a new interval starts.
+        """
+        mask = zeros((len(self), width), bool)
+        rows = repeat(arange(len(self)), diff(self.offsets))
+        inside = self.bounds < width
+        mask[rows[inside], self.bounds[inside]] = True
+        return mask
+
+    def flat(self, width):
+        r"""
+        Returns the boundaries as positions in the flattened image, as int64.
+        """
+        rows = repeat(arange(len(self), dtype=int64) * width, diff(self.offsets))
+        return self.bounds + rows
+
+    def save(self, path):
+        r"""
+        Saves the intervals to a .npz file, so a mask can be computed once and reused.
+        """
+        savez(path, offsets=self.offsets, bounds=self.bounds)
+
+    @classmethod
+    def load(cls, path):
+        r"""
+        Loads intervals saved with Intervals.save.
+        """
+        with npload(path) as data:
+            return cls(data["offsets"], data["bounds"])
+
+
+def BoundaryIntervals(black):
+    r"""
+    Turns black pixels into interval boundaries.
+    A boundary right after another one is dropped, so runs of black pixels only start one interval.
+    -----
+    :param black: ndarray of bools, shape (height, width).
+    :returns: Intervals.
+    """
+    boundaries = black.copy()
+    boundaries[2:, 2:] &= ~black[2:, 1:-1]
+    return Intervals.from_mask(boundaries)
+
+
+def EdgeIntervals(edge_img, args):
+    r"""
+    Turns an edge-filtered image into intervals.
+    Pixels at least as light as the lower threshold are boundaries.
+    -----
+    :param edge_img: PIL Image object after ImageFilter.FIND_EDGES.
+    :param args: Arguments.
+    :returns: Intervals.
+    """
+    light = HSVPlanes(PixelArray(edge_img), {}, "lightness")
+    return BoundaryIntervals(light >= args["bottom_threshold"])
+
+
+def edge(pixels, args):
+    cache = PlaneCache(pixels, args)
+    if "edges" not in cache:
+        cache["edges"] = ArrayImage(pixels).filter(ImageFilter.FIND_EDGES)
+    return EdgeIntervals(cache["edges"], args)
+
+
+def threshold(pixels, args):
+    light = KeyPlane(pixels, lightness, args)
+    return Intervals.from_mask(
+        (light < args["bottom_threshold"]) | (light > args["upper_threshold"])
+    )
+
+
+def WidthIntervals(width, rngs, draw, mean):
+    r"""
+    Builds intervals from random widths, drawn row by row from the row's own stream.
+    The widths are added up along each row and the running totals are clipped at the row width.
+    -----
+    :param width: width of the rows.
+    :param rngs: list of random generators, one per row.
+    :param draw: function taking a generator and a count and returning an ndarray of widths.
+    :param mean: average width, used to guess how many widths a row needs.
+    :returns: Intervals.
+    """
+    mask = zeros((len(rngs), width), bool)
+    for y, rng in enumerate(rngs):
+        ends = cumsum(draw(rng, int(width / mean) + 8))
+        while ends[-1] < width:
+            ends = concatenate((ends, ends[-1] + cumsum(draw(rng, len(ends) // 4 + 8))))
+        mask[y, ends[ends < width].astype(int64)] = True
+    return Intervals.from_mask(mask)
+
+
+def random(pixels, args):
+    clength = max(args["clength"], 1)
+    return WidthIntervals(
+        pixels.shape[1],
+        RowRngs(args, "intervals", len(pixels)),
+        lambda rng, count: clength * (1 - rng.random(count)),
+        clength / 2,
+    )
+
+
+def waves(pixels, args):
+    return WidthIntervals(
+        pixels.shape[1],
+        RowRngs(args, "intervals", len(pixels)),
+        lambda rng, count: args["clength"] + rng.integers(0, 11, count),
+        args["clength"] + 5,
+    )
+
+
+def file_mask(pixels, args):
+    img = ElementaryCA(pixels, args, len(pixels[0]), len(pixels)).resize(
+        (len(pixels[0]), len(pixels)), Image.LANCZOS
+    )
+    black = HSVPlanes(PixelArray(img), {}, "lightness") == 0
+    return BoundaryIntervals(black)
+
+
+def file_edges(pixels, args):
+    return EdgeIntervals(
+        ElementaryCA(pixels, args, len(pixels[0]), len(pixels))
+        .rotate(args["angle"], expand=True)
+        .resize((len(pixels[0]), len(pixels)), Image.LANCZOS)
+        .filter(ImageFilter.FIND_EDGES)
+        .convert("RGBA"),
+        args,
+    )
+
+
+# Interval functions that can be combined in a mask expression.
+MaskNames = ["random", "threshold", "edges", "waves", "file", "file-edges", "none"]
+
+
+def BoundaryMask(pixels, args, name):
+    r"""
+    The boolean (height, width) mask of where the intervals of an interval function start.
+    Masks are cached with the other planes, so every function runs once per pixel buffer.
+    -----
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
+    :param args: Arguments.
+    :param name: name of the interval function, one of MaskNames.
+    :returns: ndarray of bools.
+    """
+    cache = PlaneCache(pixels, args)
+    if ("mask", name) not in cache:
+        intervals = ReadIntervalFunction(name)(pixels, args)
+        cache[("mask", name)] = intervals.to_mask(pixels.shape[1])
+    return cache[("mask", name)]
+
+
+def CombinedIntervals(tree):
+    r"""
+    Builds an interval function from a tree made by ReadMaskExpression.
+    -----
+    :param tree: tree of tuples.
+    :returns: Interval function.
+    """
+
+    def evaluate(node, pixels, args):
+        if node[0] == "mask":
+            return BoundaryMask(pixels, args, node[1])
+        return node[0](*(evaluate(operand, pixels, args) for operand in node[1:]))
+
+    def combined(pixels, args):
+        return Intervals.from_mask(evaluate(tree, pixels, args))
+
+    return combined
+
+
+def snap_sort(pixels, args):
+    print("The hardest choices require the strongest wills...")
+    height, width = pixels.shape[:2]
+    fraction = min(max(args["fraction"], 0.0), 1.0)
+    if fraction != args["fraction"]:
+        print(
+            f"[WARNING] Snap fraction {args['fraction']} is not between 0 and 1, using {fraction}"
+        )
+    rounded = int(round(height * width * fraction))
+
+    dusted = zeros((height, width), bool)
+    dusted.flat[
+        Rng(args, "snap").choice(dusted.size, rounded, replace=False, shuffle=False)
+    ] = True
+    print(f'Number of those worthy of the sacrifice: {("{:,}".format(rounded))}')
+
+    pixels_return = where(dusted[..., None], uint8(0), pixels)
+    print(f"{('/' * 45)}\nPerfectly balanced, as all things should be.\n{('/' * 45)}")
+
+    return pixels_return
+
+
+def ShuffleLines(pixels, args, across):
     r"""
-    Sorts the image.
+    Shuffles the image along the lines at args["angle"] degrees, see LinePaths.
+    Only the real pixels of each line move, the padding of the path buffer never does.
     -----
-    :param pixels of pixel values.
-    :param intervals of pixel values after being run through selected interval function.
+    :param pixels: ndarray of pixel values, shape (height, width, 4).
     :param args: Arguments.
-    :param sorting_function: Sorting function used in sorting of pixels.
-    :returns of sorted pixels.
-    """
-    sorted_pixels = []
-    sort_interval = lambda lst, func: [] if lst == [] else sorted(lst, key=func)
-    for y in ProgressBars(len(pixels), "Sorting..."):
-        row = []
-        x_min = 0
-        for x_max in intervals[y]:
-            interval = []
-            for x in range(int(x_min), int(x_max)):
-                Append3D(interval, x, y, pixels)
-            if rand.randint(0, 100) >= args["randomness"]:
-                row += sort_interval(interval, sorting_function)
-            else:
-                row += interval
-            x_min = x_max
-        Append3D(row, 0, y, pixels)
-        Append(sorted_pixels, row)
-    return sorted_pixels
+    :param across: shuffle the order of the lines instead of the pixels along them.
+        Every line takes the pixels of another line where both reach, the pixels
+        only one of them reaches are swapped with the other lines of that column.
+        At 0 and 90 degrees whole lines move, like shuffled_axis.
+    :returns: ndarray of shuffled pixels, same shape as pixels.
+    """
+    height, width = pixels.shape[:2]
+    paths = LinePaths(args["angle"] % 360, width, height)
+    line, column = divmod(paths.pos, paths.width)
+    rng = Rng(args, "shuffle")
+    if across:
+        counts = bincount(line)
+        starts = column[concatenate(([0], cumsum(counts)[:-1]))]
+        source = rng.permutation(paths.rows)[line]
+        both = (starts[source] <= column) & (column < starts[source] + counts[source])
+        sources = empty(len(line), int64)
+        sources[both] = searchsorted(
+            paths.pos, source[both] * paths.width + column[both]
+        )
+        left = ones(len(line), bool)
+        left[sources[both]] = False
+        targets, left = (~both).nonzero()[0], left.nonzero()[0]
+        # a column has as many pixels left to take as to give
+        sources[targets[lexsort((line[targets], column[targets]))]] = left[
+            lexsort((line[left], column[left]))
+        ]
+        sources = paths.index[sources]
+    else:
+        # paths.index is in line order already
+        sources = paths.index[lexsort((rng.random(len(line)), line))]
+    shuffled = empty((height * width, 4), uint8)
+    shuffled[paths.index] = pixels.reshape(-1, 4)[sources]
+    return shuffled.reshape(pixels.shape)
 
 
-# INTERVALS #
-def edge(pixels, args):
-    edge_data = (
-        ImgOpen(args["url"], args["internet"])
-        .rotate(args["angle"], expand=True)
-        .filter(ImageFilter.FIND_EDGES)
-        .convert("RGBA")
-        .load()
+def shuffle_total(pixels, args):
+    print("Shuffling image...")
+    if args["angle"] % 360:
+        return ShuffleLines(pixels, args, across=False)
+    height, width = pixels.shape[:2]
+    order = Rng(args, "shuffle").permuted(
+        broadcast_to(arange(width), (height, width)), axis=1
     )
+    return take_along_axis(pixels, order[..., None], axis=1)
 
-    filter_pixels = PixelAppend(
-        len(pixels), len(pixels[0]), edge_data, "Finding threshold..."
-    )
-    edge_pixels = []
-    intervals = []
 
-    for y in ProgressBars(len(pixels), "Thresholding..."):
-        Append(edge_pixels, [])
-        for x in range(len(pixels[0])):
-            AppendBW(edge_pixels, x, y, filter_pixels, args["bottom_threshold"])
+def shuffled_axis(pixels, args):
+    print("Shuffling image...")
+    if args["angle"] % 360:
+        return ShuffleLines(pixels, args, across=True)
+    return pixels[Rng(args, "shuffle").permutation(len(pixels))]
 
-    for y in tqdm(
-        range(len(pixels) - 1, 1, -1), desc=("{:30}".format("Cleaning up..."))
-    ):
-        for x in range(len(pixels[0]) - 1, 1, -1):
-            if edge_pixels[y][x] == BlackPixel and edge_pixels[y][x - 1] == BlackPixel:
-                edge_pixels[y][x] = WhitePixel
 
-    for y in ProgressBars(len(pixels), "Defining intervals..."):
-        Append(intervals, [])
-        for x in range(len(pixels[0])):
-            if edge_pixels[y][x] == BlackPixel:
-                AppendInPlace(intervals, y, x)
-        AppendInPlace(intervals, y, len(pixels[0]))
-    return intervals
+def none(pixels, args):
+    height, width = pixels.shape[:2]
+    return Intervals(arange(height + 1), repeat(width, height))
 
 
-def threshold(pixels, args):
-    intervals = []
+# DEADLINES #
+class DeadlineExceeded(Exception):
+    r"""
+    Raised between the stages of a run once its time budget (-w) ran out.
+    """
 
-    for y in ProgressBars(len(pixels), "Determining intervals..."):
-        Append(intervals, [])
-        for x in range(len(pixels[0])):
-            if (
-                lightness(pixels[y][x]) < args["bottom_threshold"]
-                or lightness(pixels[y][x]) > args["upper_threshold"]
-            ):
-                AppendInPlace(intervals, y, x)
-        AppendInPlace(intervals, y, len(pixels[0]))
-    return intervals
 
+# Rough seconds per megapixel of sorting, on top of encoding, by interval function.
+SecondsPerMegapixel = {
+    "edges": 0.6,
+    "file": 0.6,
+    "file-edges": 0.7,
+    "shuffle-axis": 0.1,
+}
 
-def random(pixels, args):
-    intervals = []
 
-    for y in ProgressBars(len(pixels), "Determining intervals..."):
-        Append(intervals, [])
-        x = 0
-        while True:
-            width = RandomWidth(args["clength"])
-            x += width
-            if x > len(pixels[0]):
-                AppendInPlace(intervals, y, len(pixels[0]))
-                break
-            else:
-                AppendInPlace(intervals, y, x)
-    return intervals
+def CheckDeadline(args, stage):
+    r"""
+    Stops the run if it is past its deadline.
+    -----
+    :param args: Arguments, args["deadline"] is a time.perf_counter() value or None.
+    :param stage: name of the stage about to start, for the message.
+    :raises DeadlineExceeded: the deadline has passed.
+    """
+    deadline = args.get("deadline")
+    if deadline and perf_counter() > deadline:
+        raise DeadlineExceeded(
+            f"Time budget of {args['budget']} s ran out before {stage}"
+        )
 
 
-def waves(pixels, args):
-    intervals = []
+def EstimateSeconds(width, height, args):
+    r"""
+    Estimates how long sorting and encoding an image takes, from its size and args.
+    -----
+    :param width: width of the image.
+    :param height: height of the image.
+    :param args: Arguments.
+    :returns: float of seconds.
+    """
+    if args.get("pipeline"):
+        passes = [step.split(":") for step in args["pipeline"].split("|")]
+        names = [word for step in passes for word in step]
+    else:
+        passes, names = [None], findall(r"[a-z][a-z-]*", args["int_function"])
+    per_pass = max([SecondsPerMegapixel.get(name, 0.45) for name in names] or [0.45])
+    if args["angle"] % 360 or args.get("path"):
+        per_pass *= 1.2
+    return width * height / 1e6 * (per_pass * len(passes) + 0.3)
+
+
+def BudgetSort(
+    input_img,
+    args,
+    interval_function,
+    sorting_function,
+    shuffled=False,
+    snapped=False,
+    pixels=None,
+):
+    r"""
+    Sorts an image within args["budget"] seconds, see RunSort.
+    If the estimate is over the budget, a smaller copy is sorted and scaled back up.
+    Stages check the deadline, so a run that still overruns stops with DeadlineExceeded.
+    args["render_path"] says which path was taken.
+    -----
+    :returns: PIL Image.
+    :raises DeadlineExceeded: the time budget ran out.
+    """
+    args["deadline"] = perf_counter() + args["budget"]
+    width, height = input_img.size
+    estimate = EstimateSeconds(width, height, args)
+    try:
+        if estimate <= args["budget"]:
+            args["render_path"] = "full"
+            return RunSort(
+                input_img,
+                args,
+                interval_function,
+                sorting_function,
+                shuffled,
+                snapped,
+                pixels,
+            )
+        scale = (args["budget"] / estimate) ** 0.5
+        size = (max(int(width * scale), 1), max(int(height * scale), 1))
+        args["render_path"] = f"downscaled to {size[0]}x{size[1]}"
+        print(
+            f"Estimated {estimate:.1f} s is over the budget of {args['budget']} s, "
+            f"sorting at {size[0]}x{size[1]}..."
+        )
+        # lengths in pixels shrink with the image, mask images are resized anyway
+        small_args = dict(args, clength=args["clength"] * scale)
+        if args.get("roi") and not path.isfile(args["roi"]):
+            small_args["roi"] = sub(
+                r"[\d.]+", lambda m: str(float(m.group()) * scale), args["roi"]
+            )
+        output_img = RunSort(
+            input_img.resize(size, Image.LANCZOS),
+            small_args,
+            interval_function,
+            sorting_function,
+            shuffled,
+            snapped,
+        )
+        # the automaton of file, file-edges and snap runs is uploaded from args
+        if "ca_image" in small_args:
+            args["ca_image"] = small_args["ca_image"]
+        return output_img.resize((width, height), Image.NEAREST)
+    except DeadlineExceeded:
+        args["render_path"] = "cancelled"
+        raise
+    finally:
+        args["deadline"] = None
+
+
+# MAIN #
+def RunSort(
+    input_img,
+    args,
+    interval_function,
+    sorting_function,
+    shuffled=False,
+    snapped=False,
+    pixels=None,
+):
+    r"""
+    Sorts an image with the chosen interval and sorting functions and args.
+    -----
+    :param input_img: PIL Image.
+    :param args: Arguments.
+    :param interval_function: Interval function.
+    :param sorting_function: Sorting function used in sorting of pixels.
+    :param shuffled: is the interval function shuffled?
+    :param snapped: is the interval function snapped?
+    :param pixels: PixelArray(input_img) if already at hand, planes cached from it are reused.
+    :returns: PIL Image.
+    :raises DeadlineExceeded: the time budget ran out.
+    """
+    if args.get("budget") and not args.get("deadline"):
+        return BudgetSort(
+            input_img,
+            args,
+            interval_function,
+            sorting_function,
+            shuffled,
+            snapped,
+            pixels,
+        )
+    streamed = (
+        args["stream"] > 0
+        and not (args["pipeline"] or args["path"] or args["roi"])
+        and args["angle"] % 360 == 0
+        and interval_function.__name__ in RowFunctions
+    )
+    print("Getting data...")
+    if streamed:
+        pixels = None
+    elif pixels is None:
+        pixels = PixelArray(input_img)
+    shuffled = not args["pipeline"] and (
+        shuffled or args["int_function"] in ["shuffle-total", "shuffle-axis"]
+    )
+
+    if streamed:
+        sorted_pixels = StreamSort(
+            input_img, None, args, interval_function, sorting_function
+        )
+    elif args["pipeline"]:
+        sorted_pixels = RunPipeline(pixels, ReadPipeline(args["pipeline"]), args)
+    elif shuffled:
+        sorted_pixels = interval_function(pixels, args)
+    elif snapped or args["int_function"] == "snap":
+        sorted_pixels = SortPass(pixels, args, file_edges, sorting_function)
+        print(
+            f"{('/' * 45)}\n"
+            f"Dread it. Run from it. Destiny still arrives."
+            f"\n{('/' * 45)}"
+        )
+        print("I am... inevitable...")
+        sorted_pixels = interval_function(sorted_pixels, args)
+    else:
+        sorted_pixels = SortPass(pixels, args, interval_function, sorting_function)
 
-    for y in ProgressBars(len(pixels), "Determining intervals..."):
-        Append(intervals, [])
-        x = 0
+    CheckDeadline(args, "building the output image")
+    print("Building output image...")
+    return ArrayImage(sorted_pixels)
+
+
+# Marks the end of the jobs passed between batch stages.
+StageEnd = object()
+
+
+def Stage(function, inbox, outbox, workers):
+    r"""
+    Starts threads that take jobs from inbox, run function on them and put them in outbox.
+    Jobs that failed in an earlier stage are passed on untouched. After StageEnd
+    comes in and every thread is done, StageEnd is passed on.
+    -----
+    :param function: function taking a job dict and updating it in place.
+    :param inbox: Queue of jobs.
+    :param outbox: Queue of jobs, bounded so a fast stage waits for a slow one.
+    :param workers: number of threads.
+    :returns: list of threads.
+    """
+    running = [workers]
+    lock = Lock()
+
+    def work():
         while True:
-            width = args["clength"] + rand.randint(0, 10)
-            x += width
-            if x > len(pixels[0]):
-                AppendInPlace(intervals, y, len(pixels[0]))
-                break
-            else:
-                AppendInPlace(intervals, y, x)
-    return intervals
+            job = inbox.get()
+            if job is StageEnd:
+                # let the other threads of this stage see the end too
+                inbox.put(StageEnd)
+                with lock:
+                    running[0] -= 1
+                    if running[0] == 0:
+                        outbox.put(StageEnd)
+                return
+            if "error" not in job:
+                try:
+                    function(job)
+                except Exception as error:
+                    job["error"] = error
+            outbox.put(job)
 
+    threads = [Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
 
-def file_mask(pixels, args):
-    img = ElementaryCA(pixels, args, int(len(pixels)), int(len(pixels[0]))).resize(
-        (len(pixels[0]), len(pixels)), Image.ANTIALIAS
-    )
-    data = img.load()
 
-    file_pixels = PixelAppend(len(pixels), len(pixels[0]), data, "Defining edges...")
-    intervals = []
+def FetchJob(job):
+    r"""
+    Downloads or reads the image file of a batch job.
+    """
+    if urlparse(job["input"]).scheme in ["http", "https"]:
+        response = get(job["input"], timeout=60)
+        response.raise_for_status()
+        job["data"] = response.content
+    else:
+        with open(job["input"], "rb") as f:
+            job["data"] = f.read()
 
-    for y in tqdm(
-        range(len(pixels) - 1, 1, -1), desc=("{:30}".format("Cleaning up edges..."))
-    ):
-        for x in range(len(pixels[0]) - 1, 1, -1):
-            if file_pixels[y][x] == BlackPixel and file_pixels[y][x - 1] == BlackPixel:
-                file_pixels[y][x] = WhitePixel
 
-    for y in ProgressBars(len(pixels), "Defining intervals..."):
-        Append(intervals, [])
-        for x in range(len(pixels[0])):
-            if file_pixels[y][x] == BlackPixel:
-                AppendInPlace(intervals, y, x)
-        AppendInPlace(intervals, y, len(pixels[0]))
+def DecodeJob(job):
+    r"""
+    Decodes the image of a batch job.
+    """
+    job["img"] = Image.open(BytesIO(job.pop("data")))
+    job["img"].load()
+    job["pixels"] = job["img"].width * job["img"].height
 
-    return intervals
 
+def BatchSort(input_img, args):
+    r"""
+    Sorts one image for Batch, runs in a worker process.
+    -----
+    :param input_img: PIL Image.
+    :param args: Arguments.
+    :returns: (in order) PIL Image, render path ("full" or "downscaled to WxH").
+    :raises DeadlineExceeded: the time budget (-w) ran out.
+    """
+    with open(devnull, "w") as quiet, redirect_stdout(quiet):
+        output_img = RunSort(
+            input_img,
+            args,
+            ReadIntervalFunction(args["int_function"]),
+            ReadSortingFunction(args["sorting_function"]),
+        )
+    return output_img, args.get("render_path", "full")
 
-def file_edges(pixels, args):
-    edge_data = (
-        ElementaryCA(pixels, args, int(len(pixels)), int(len(pixels[0])))
-        .rotate(args["angle"], expand=True)
-        .resize((len(pixels[0]), len(pixels)), Image.ANTIALIAS)
-        .filter(ImageFilter.FIND_EDGES)
-        .convert("RGBA")
-        .load()
+
+def EncodeJob(job):
+    r"""
+    Saves the sorted image of a batch job.
+    The image is saved under a temporary name first, so a worker dying mid-save
+    never leaves a half written output that a rerun would skip.
+    """
+    job.pop("img").save(job["output"] + ".tmp", "PNG")
+    rename(job["output"] + ".tmp", job["output"])
+
+
+def UploadJob(job):
+    r"""
+    Uploads the saved image of a batch job.
+    """
+    job["link"], uploaded = UploadImg(job["output"])
+    if not uploaded:
+        raise IOError(f"upload of {job['output']} failed")
+
+
+def BatchJobs(input_source, output_dir):
+    r"""
+    Lists the images of a batch, skipping those already sorted.
+    -----
+    :param input_source: directory of images, or a text file with an image path or URL per line.
+    :param output_dir: directory the sorted .png images go to, images with the same name
+        get a number, e.g. img0.png and img0-2.png.
+    :returns: (in order) list of job dicts with "input" and "output", number of images skipped.
+    """
+    if path.isdir(input_source):
+        extensions = Image.registered_extensions()
+        inputs = [
+            path.join(input_source, file_name)
+            for file_name in sorted(listdir(input_source))
+            if path.splitext(file_name)[1].lower() in extensions
+        ]
+    else:
+        with open(input_source) as f:
+            inputs = [line.strip() for line in f if line.strip()]
+    jobs, skipped, taken = [], 0, set()
+    for input_path in inputs:
+        stem = path.splitext(path.basename(urlparse(input_path).path))[0] or IDGen(5)
+        output_path = path.join(output_dir, stem + ".png")
+        # e.g. img0.jpg and img0.png, or two URLs ending in the same name
+        count = 1
+        while output_path in taken:
+            count += 1
+            output_path = path.join(output_dir, f"{stem}-{count}.png")
+        if count > 1:
+            print(
+                f"[WARNING] {input_path} has the same name as an earlier image, "
+                f"saving it as {path.basename(output_path)}"
+            )
+        taken.add(output_path)
+        if path.exists(output_path):
+            skipped += 1
+        else:
+            Append(jobs, {"input": input_path, "output": output_path})
+    return jobs, skipped
+
+
+def HeadlessArgs(args_namespace):
+    r"""
+    Arguments for sorting without prompts, from parsed command line arguments.
+    Every image is sorted in one process and nothing is looked up online.
+    -----
+    :param args_namespace: parsed arguments, with int_function and sorting_function.
+    :returns: dict of arguments.
+    """
+    __args = dict(vars(args_namespace))
+    __args.update(
+        {
+            "pipeline": (
+                " ".join(args_namespace.pipeline) if args_namespace.pipeline else None
+            ),
+            "jobs": 1,
+            "batch": True,
+            "filelink": "",
+            "presetname": "None",
+            "dbpreset": False,
+            "preset": False,
+            "internet": False,
+        }
     )
+    return __args
+
+
+def Batch(arguments):
+    r"""
+    Sorts every image of a batch without any prompts.
+    Downloading, decoding, sorting, saving and uploading run as stages in their own threads,
+    connected by bounded queues, so the next image downloads while the current one sorts and
+    the previous one uploads. Sorting runs in a process pool, several images at once.
+    Images whose output already exists are skipped, so an interrupted batch can be rerun.
+    -----
+    :param arguments: command line arguments after "batch".
 
-    filter_pixels = PixelAppend(
-        len(pixels), len(pixels[0]), edge_data, "Defining edges..."
+    Example
+    -----
+    >>> python3 pixelsort.py batch INPUT_DIR OUTPUT_DIR --int threshold --sort hue -t .3 -u .8 --jobs 8
+    """
+    parse = ArgParsing()[0]
+    batch = argparse.ArgumentParser(
+        prog="pixelsort.py batch",
+        description="pixel sort every image in a directory",
+        parents=[parse],
+        conflict_handler="resolve",
+    )
+    batch.add_argument(
+        "input_dir",
+        help="Directory of images to sort, or a text file with an image path or URL per line.",
+    )
+    batch.add_argument("output_dir", help="Directory the sorted .png images go to.")
+    batch.add_argument(
+        "--int",
+        dest="int_function",
+        help="random, threshold, edges, waves, snap, shuffle-total, shuffle-axis, file, file-edges, none, or a combination like threshold & ~edges",
+        default="random",
+    )
+    batch.add_argument(
+        "--sort",
+        dest="sorting_function",
+        help="lightness, intensity, hue, saturation, minimum, or several separated by commas, '-' for descending",
+        default="lightness",
+    )
+    batch.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of images sorted at once, 0 for one per core",
+        default=0,
+    )
+    batch.add_argument(
+        "--upload",
+        action="store_true",
+        help="Upload every sorted image, the links are saved to links.txt in the output directory.",
+    )
+    batch.add_argument(
+        "--queue",
+        type=int,
+        help="How many images may wait between two stages.",
+        default=2,
+    )
+    batch.add_argument(
+        "--spool",
+        help="Write the jobs to this spool directory for 'worker' processes instead of sorting them here.",
+        default=None,
+    )
+    args_namespace = batch.parse_args(arguments)
+    __args = HeadlessArgs(args_namespace)
+    makedirs(args_namespace.output_dir, exist_ok=True)
+    todo, skipped = BatchJobs(args_namespace.input_dir, args_namespace.output_dir)
+    if args_namespace.spool:
+        SpoolJobs(args_namespace.spool, todo, __args)
+        print(
+            f"Spooled {len(todo)} images to {args_namespace.spool}, skipping {skipped} already sorted."
+        )
+        return
+    print(f"Sorting {len(todo)} images, skipping {skipped} already sorted...")
+    jobs = args_namespace.jobs if args_namespace.jobs > 0 else cpu_count()
+    sorted_count, failed, pixel_count = 0, 0, 0
+    start = perf_counter()
+    with ProcessPoolExecutor(jobs) as pool:
+
+        def SortJob(job):
+            job["img"], job["render_path"] = pool.submit(
+                BatchSort, job["img"], __args
+            ).result()
+
+        queues = [Queue(max(args_namespace.queue, 1)) for _ in range(6)]
+        stages = [
+            (FetchJob, 4),
+            (DecodeJob, 1),
+            (SortJob, jobs),
+            (EncodeJob, 1),
+            (UploadJob if args_namespace.upload else lambda job: None, 4),
+        ]
+        for (function, workers), inbox, outbox in zip(stages, queues, queues[1:]):
+            Stage(function, inbox, outbox, workers)
+
+        def Feed():
+            for job in todo:
+                queues[0].put(job)
+            queues[0].put(StageEnd)
+
+        Thread(target=Feed, daemon=True).start()
+        for job in iter(queues[-1].get, StageEnd):
+            if "error" in job:
+                failed += 1
+                print(f"[WARNING] Failed to sort {job['input']}: {job['error']}")
+                continue
+            sorted_count += 1
+            pixel_count += job["pixels"]
+            if job["render_path"] != "full":
+                print(f"{job['input']} was {job['render_path']} to fit the time budget")
+            if "link" in job:
+                print(f"{job['input']} -> {job['link']}")
+                with open(path.join(args_namespace.output_dir, "links.txt"), "a") as f:
+                    f.write(f"{job['input']} {job['link']}\n")
+    seconds = max(perf_counter() - start, 1e-9)
+    print(
+        f"Sorted {sorted_count} images ({pixel_count / 1e6:.1f} MP) in {seconds:.1f} s "
+        f"with {jobs} processes: {sorted_count / seconds:.2f} images/s, "
+        f"{pixel_count / 1e6 / seconds:.1f} MP/s. "
+        f"Skipped {skipped}, failed {failed}."
     )
-    edge_pixels = []
-    intervals = []
 
-    for y in ProgressBars(len(pixels), "Thresholding..."):
-        Append(edge_pixels, [])
-        for x in range(len(pixels[0])):
-            AppendBW(edge_pixels, x, y, filter_pixels, args["bottom_threshold"])
 
-    for y in tqdm(
-        range(len(pixels) - 1, 1, -1), desc=("{:30}".format("Cleaning up edges..."))
-    ):
-        for x in range(len(pixels[0]) - 1, 1, -1):
-            if edge_pixels[y][x] == BlackPixel and edge_pixels[y][x - 1] == BlackPixel:
-                edge_pixels[y][x] = WhitePixel
+# SPOOL #
+def SpoolDirs(spool):
+    r"""
+    The directories of a spool, made if missing.
+    - queue -> job files waiting for a worker.
+    - claimed -> job files a worker is sorting, renamed to end with the worker's name.
+    - status -> one status file per finished job.
+    -----
+    :param spool: spool directory, shared by every worker, e.g. over NFS.
+    :returns: (in order) queue, claimed, status directory paths.
+    """
+    dirs = tuple(path.join(spool, sub) for sub in ["queue", "claimed", "status"])
+    for spool_dir in dirs:
+        makedirs(spool_dir, exist_ok=True)
+    return dirs
 
-    for y in ProgressBars(len(pixels), "Defining intervals..."):
-        Append(intervals, [])
-        for x in range(len(pixels[0])):
-            if edge_pixels[y][x] == BlackPixel:
-                AppendInPlace(intervals, y, x)
-        AppendInPlace(intervals, y, len(pixels[0]))
-    return intervals
 
+def WriteAtomic(file_path, text):
+    r"""
+    Writes a file under a temporary name first, so readers never see it half written.
+    """
+    with open(file_path + ".tmp", "w") as f:
+        f.write(text)
+    rename(file_path + ".tmp", file_path)
 
-def snap_sort(pixels, args):
-    input_img = ImgOpen("images/thanos_img.png", False)
-    pixels_snap = array(input_img)
 
-    print("The hardest choices require the strongest wills...")
-    nx, ny = input_img.size
-    xy = mgrid[:nx, :ny].reshape(2, -1).T
-    rounded = int(round(int(xy.shape[0] / 2), 0))
+def SpoolJobs(spool, jobs, args):
+    r"""
+    Writes batch jobs to the queue of a spool.
+    -----
+    :param spool: spool directory.
+    :param jobs: list of job dicts from BatchJobs.
+    :param args: Arguments every job is sorted with.
+    """
+    queue_dir = SpoolDirs(spool)[0]
+    for job in jobs:
+        job_id = f"{path.splitext(path.basename(job['output']))[0]}-{IDGen(5)}"
+        WriteAtomic(
+            path.join(queue_dir, job_id + ".json"),
+            dumps(
+                {
+                    "input": (
+                        job["input"]
+                        if urlparse(job["input"]).scheme in ["http", "https"]
+                        else path.abspath(job["input"])
+                    ),
+                    "output": path.abspath(job["output"]),
+                    "args": args,
+                }
+            ),
+        )
+
+
+def ClaimJob(queue_dir, claimed_dir, worker_name):
+    r"""
+    Claims the oldest job in the queue by renaming it, which only one worker can do.
+    Jobs are taken in the order they were queued, by modification time.
+    -----
+    :param queue_dir: queue directory of the spool.
+    :param claimed_dir: claimed directory of the spool.
+    :param worker_name: name added to the claimed file.
+    :returns: path of the claimed job file, or None if the queue is empty.
+    """
+    queued = []
+    for file_name in listdir(queue_dir):
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            queued.append((path.getmtime(path.join(queue_dir, file_name)), file_name))
+        except FileNotFoundError:
+            continue
+    for _, file_name in sorted(queued):
+        claimed_path = path.join(claimed_dir, f"{file_name[:-5]}.{worker_name}.json")
+        try:
+            rename(path.join(queue_dir, file_name), claimed_path)
+        except FileNotFoundError:
+            # another worker claimed it first
+            continue
+        return claimed_path
+    return None
+
+
+def Worker(arguments):
+    r"""
+    Sorts jobs from a spool directory until it is empty or forever.
+    Any number of workers on any number of machines can share one spool, jobs are
+    claimed by renaming them and no broker is needed. Jobs left in claimed by a worker
+    that died can be moved back to queue by hand.
+    -----
+    :param arguments: command line arguments after "worker".
 
-    numbers_that_dont_feel_so_good = xy.take(
-        choice(xy.shape[0], rounded, replace=False), axis=0
+    Example
+    -----
+    >>> python3 pixelsort.py batch INPUT_DIR OUTPUT_DIR --int threshold --spool /mnt/spool
+    >>> python3 pixelsort.py worker --spool /mnt/spool
+    """
+    worker = argparse.ArgumentParser(
+        prog="pixelsort.py worker", description="sort jobs from a spool directory"
     )
-    print(f'Number of those worthy of the sacrifice: {("{:,}".format(rounded))}')
+    worker.add_argument("--spool", help="Spool directory.", required=True)
+    worker.add_argument(
+        "--once", action="store_true", help="Stop when the queue is empty."
+    )
+    worker.add_argument(
+        "--poll",
+        type=float,
+        help="Seconds between looks at an empty queue.",
+        default=2.0,
+    )
+    args_namespace = worker.parse_args(arguments)
+    queue_dir, claimed_dir, status_dir = SpoolDirs(args_namespace.spool)
+    worker_name = f"{socket.gethostname()}-{getpid()}"
+    print(f"Worker {worker_name} sorting jobs from {args_namespace.spool}...")
+    while True:
+        claimed_path = ClaimJob(queue_dir, claimed_dir, worker_name)
+        if claimed_path is None:
+            if args_namespace.once:
+                return
+            sleep(args_namespace.poll)
+            continue
+        job_id = path.basename(claimed_path)[: -len(f".{worker_name}.json")]
+        start = perf_counter()
+        try:
+            with open(claimed_path) as f:
+                job = loads(f.read())
+            job["pixels"] = 0
+            FetchJob(job)
+            DecodeJob(job)
+            job["img"], render_path = BatchSort(job["img"], job["args"])
+            makedirs(path.dirname(job["output"]), exist_ok=True)
+            EncodeJob(job)
+            status = {
+                "status": "done",
+                "output": job["output"],
+                "render_path": render_path,
+            }
+        except DeadlineExceeded as error:
+            status = {"status": "cancelled", "error": str(error)}
+        except Exception as error:
+            status = {"status": "failed", "error": str(error)}
+        status.update(
+            {
+                "job": job_id,
+                "worker": worker_name,
+                "seconds": round(perf_counter() - start, 3),
+                "finished": datetime.now().isoformat(),
+            }
+        )
+        WriteAtomic(path.join(status_dir, job_id + ".json"), dumps(status))
+        remove(claimed_path)
+        print(f"{job_id}: {status['status']}")
 
-    for i in ProgressBars(len(numbers_that_dont_feel_so_good), "Snapping..."):
-        pixels_snap[numbers_that_dont_feel_so_good[i][1]][
-            numbers_that_dont_feel_so_good[i][0]
-        ] = [0, 0, 0, 0]
 
-    print("Sorted perfectly in half.")
-    returned_souls = Image.fromarray(pixels_snap, "RGBA")
-    returned_souls.save("images/snapped_pixels.png")
+# SERVE #
+def ServeSort(data, args):
+    r"""
+    Sorts one image for the render service, runs in a warm worker process.
+    -----
+    :param data: bytes of an image file.
+    :param args: Arguments.
+    :returns: (in order) bytes of the sorted PNG, render path.
+    """
+    output = BytesIO()
+    output_img, render_path = BatchSort(Image.open(BytesIO(data)), args)
+    output_img.save(output, "PNG")
+    return output.getvalue(), render_path
 
-    snapped_img = ImgOpen("images/snapped_pixels.png", False)
-    data = snapped_img.load()
-    size0, size1 = snapped_img.size
-    pixels_return = PixelAppend(size1, size0, data, "I hope they remember you...")
 
-    RemoveOld("images/snapped_pixels.png")
-    RemoveOld("images/thanos_img.png")
-    print(f"{('/' * 45)}\nPerfectly balanced, as all things should be.\n{('/' * 45)}")
+class SortHandler(BaseHTTPRequestHandler):
+    r"""
+    Requests to the render service.
+    - POST /sort?int=threshold&sort=hue&t=0.3 with an image file as the body returns the
+      sorted PNG. Other query keys are sort args by flag, short (t) or long (bottom_threshold).
+    - GET /status returns the running and waiting jobs as JSON.
+    """
 
-    return pixels_return
+    def Reply(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def Status(self):
+        with self.server.lock:
+            jobs = self.server.jobs
+            return {
+                "running": min(self.server.in_flight, jobs),
+                "waiting": max(self.server.in_flight - jobs, 0),
+                "workers": jobs,
+                "limit": self.server.limit,
+            }
 
+    def do_GET(self):
+        if urlparse(self.path).path != "/status":
+            return self.send_error(404)
+        self.Reply(200, "application/json", dumps(self.Status()).encode())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/sort":
+            return self.send_error(404)
+        if not self.headers.get("Content-Length"):
+            return self.send_error(411)
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        arguments = []
+        for key, value in parse_qsl(url.query):
+            if key not in ["int", "sort"]:
+                arguments += [("-" if len(key) == 1 else "--") + key, value]
+        try:
+            args_namespace = self.server.parse.parse_args(arguments)
+        except SystemExit:
+            return self.send_error(400, "Invalid sort arguments")
+        query = dict(parse_qsl(url.query))
+        args_namespace.int_function = query.get("int", "random")
+        args_namespace.sorting_function = query.get("sort", "lightness")
+        args = HeadlessArgs(args_namespace)
+        # a worker writing a .npy file on request isn't wanted, nor nested process pools
+        args["stream"] = 0
+
+        with self.server.lock:
+            if self.server.in_flight >= self.server.limit:
+                full = True
+            else:
+                full = False
+                self.server.in_flight += 1
+        if full:
+            self.send_response(503)
+            self.send_header("Retry-After", "1")
+            self.end_headers()
+            return
+        start = perf_counter()
+        try:
+            body, render_path = self.server.pool.submit(ServeSort, data, args).result()
+        except DeadlineExceeded as error:
+            return self.send_error(504, str(error))
+        except Exception as error:
+            return self.send_error(422, f"Sorting failed: {error}")
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Sort-Seconds", f"{perf_counter() - start:.3f}")
+        self.send_header("X-Render-Path", render_path)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def Serve(arguments):
+    r"""
+    Runs a local HTTP render service with a pool of warm worker processes.
+    Jobs past the number of workers wait, past the limit they are turned away with 503.
+    -----
+    :param arguments: command line arguments after "serve".
 
-def shuffle_total(pixels, args):
-    print("Creating array from image...")
-    input_img = ImgOpen(args["url"], args["internet"]).convert("RGBA")
-    height = input_img.size[1]
-    shuffled = array(input_img)
+    Example
+    -----
+    >>> python3 pixelsort.py serve --port 8080 --jobs 4
+    >>> curl --data-binary @image.jpg "localhost:8080/sort?int=threshold&sort=hue&t=0.3" -o sorted.png
+    """
+    serve = argparse.ArgumentParser(
+        prog="pixelsort.py serve", description="pixel sorting render service"
+    )
+    serve.add_argument("--host", help="Address to listen on.", default="127.0.0.1")
+    serve.add_argument("--port", type=int, help="Port to listen on.", default=8080)
+    serve.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of worker processes, 0 for one per core",
+        default=0,
+    )
+    serve.add_argument(
+        "--queue",
+        type=int,
+        help="How many jobs may wait for a worker before requests are turned away.",
+        default=16,
+    )
+    args_namespace = serve.parse_args(arguments)
+    jobs = args_namespace.jobs if args_namespace.jobs > 0 else cpu_count()
 
-    for i in ProgressBars(int(height), "Shuffling image..."):
-        shuffle(shuffled[i])
-    print("Saving shuffled image...")
-    shuffled_img = Image.fromarray(shuffled, "RGBA")
-    data = shuffled_img.load()
+    server = ThreadingHTTPServer(
+        (args_namespace.host, args_namespace.port), SortHandler
+    )
+    server.parse = ArgParsing()[0]
+    server.jobs = jobs
+    server.limit = jobs + max(args_namespace.queue, 0)
+    server.lock = Lock()
+    server.in_flight = 0
+    with ProcessPoolExecutor(jobs) as server.pool:
+        # start every worker now, so the first requests don't wait for them
+        blank = BytesIO()
+        Image.new("RGB", (2, 2)).save(blank, "PNG")
+        warm_args = HeadlessArgs(server.parse.parse_args([]))
+        warm_args.update({"int_function": "none", "sorting_function": "lightness"})
+        for sort in [
+            server.pool.submit(ServeSort, blank.getvalue(), warm_args)
+            for _ in range(jobs)
+        ]:
+            sort.result()
+        print(
+            f"Serving on http://{args_namespace.host}:{args_namespace.port} "
+            f"with {jobs} workers..."
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Stopping...")
+        finally:
+            server.server_close()
 
-    size0, size1 = input_img.size
-    pixels = PixelAppend(size1, size0, data, "Recreating image...")
 
-    RemoveOld("images/shuffled.png")
-    return pixels
+# ANIMATE #
+def ReadSchedule(sweeps, frames):
+    r"""
+    The flags of every frame of an animation, from --sweep inputs.
+    A sweep is KEY=A:B[:C...], its keyframes spread evenly over the frames with linear steps
+    in between, e.g. t=0.1:0.6:0.1 raises the lower threshold and lowers it again.
+    Keys are short or long flags without dashes. Sweeps of whole numbers stay whole.
+    -----
+    :param sweeps: list of sweep inputs.
+    :param frames: number of frames.
+    :returns: list of flag lists, one per frame.
+    """
+    schedule = [[] for _ in range(frames)]
+    for sweep in sweeps:
+        key, _, values = sweep.partition("=")
+        keyframes = [float(value) for value in values.split(":")]
+        steps = max(len(keyframes) - 1, 1)
+        for frame, flags in enumerate(schedule):
+            at = frame / max(frames - 1, 1) * steps
+            step = min(int(at), len(keyframes) - 1)
+            value = keyframes[step]
+            if step < len(keyframes) - 1:
+                value += (keyframes[step + 1] - value) * (at - step)
+            flags += [
+                ("-" if len(key) == 1 else "--") + key,
+                str(round(value)) if "." not in values else f"{value:.6g}",
+            ]
+    return schedule
 
 
-def shuffled_axis(pixels, args):
-    print("Creating array from image...")
-    input_img = ImgOpen(args["url"], args["internet"]).convert("RGBA")
-    height = input_img.size[1]
-    shuffled = array(input_img)
+def SaveFrames(frames, output, fps):
+    r"""
+    Writes the frames of an animation as they are rendered.
+    Frames go to numbered PNGs in a directory, one file at a time, unless output is a .gif or
+    .webp file. Pillow keeps the frames of those until the end, GIF frames as palette images.
+    -----
+    :param frames: iterator of PIL Images.
+    :param output: path of a directory, .gif or .webp file.
+    :param fps: frames per second of .gif and .webp files.
+    :returns: number of frames written.
+    """
+    extension = path.splitext(output)[1].lower()
+    count = 0
+    if extension not in [".gif", ".webp"]:
+        makedirs(output, exist_ok=True)
+        for count, frame in enumerate(frames, 1):
+            frame.save(path.join(output, f"{count:04}.png"))
+        return count
+    if extension == ".gif":
+        frames = (frame.convert("RGB").quantize() for frame in frames)
+    first = next(frames, None)
+    if first is None:
+        return count
+    counts = [1]
+
+    def Counted():
+        for frame in frames:
+            counts[0] += 1
+            yield frame
+
+    first.save(
+        output,
+        save_all=True,
+        append_images=Counted(),
+        duration=round(1000 / fps),
+        loop=0,
+    )
+    return counts[0]
+
 
-    for _ in ProgressBars(height, "Shuffling image..."):
-        shuffle(shuffled)
-    print("Saving shuffled image...")
-    shuffled_img = Image.fromarray(shuffled, "RGBA")
-    data = shuffled_img.load()
+def Animate(arguments):
+    r"""
+    Renders an animation from one image, sweeping sort args over the frames.
+    The image is downloaded and decoded once. Planes that don't depend on the swept args
+    (key planes, HSV, edge maps) are computed on the first frame and reused, line and curve
+    indices come from their caches. Every frame uses the same seed, so random intervals only
+    move as the swept args do, sweep -e to draw new ones each frame.
+    -----
+    :param arguments: command line arguments after "animate".
 
-    size0, size1 = input_img.size
-    pixels = PixelAppend(size1, size0, data, "Recreating image...")
+    Example
+    -----
+    >>> python3 pixelsort.py animate image.jpg loop.webp --int threshold --sort hue --frames 48 --sweep t=0.1:0.5:0.1 --sweep a=0:45
+    """
+    parse = ArgParsing()[0]
+    animate = argparse.ArgumentParser(
+        prog="pixelsort.py animate",
+        description="render a pixel sorted animation from one image",
+        parents=[parse],
+        conflict_handler="resolve",
+    )
+    animate.add_argument("input", help="image path or URL")
+    animate.add_argument(
+        "output", help=".webp or .gif file, or a directory for numbered PNGs"
+    )
+    animate.add_argument("--int", dest="int_function", default="random")
+    animate.add_argument("--sort", dest="sorting_function", default="lightness")
+    animate.add_argument("--frames", type=int, help="Number of frames", default=24)
+    animate.add_argument(
+        "--sweep",
+        action="append",
+        metavar="KEY=A:B",
+        help="Arg swept over the frames, e.g. t=0.1:0.6 or a=0:90:0, can be repeated",
+        default=[],
+    )
+    animate.add_argument(
+        "--fps", type=float, help="Frames per second of .gif and .webp", default=12
+    )
+    args_namespace = animate.parse_args(arguments)
+    if args_namespace.seed is None:
+        arguments = arguments + ["-e", str(rand.randrange(2**32))]
+    try:
+        schedule = ReadSchedule(args_namespace.sweep, max(args_namespace.frames, 1))
+    except ValueError:
+        animate.error(f"invalid --sweep in {args_namespace.sweep}")
+    frame_args = []
+    for flags in schedule:
+        __args = HeadlessArgs(animate.parse_args(arguments + flags))
+        # frames share one process, and a .npy file per frame isn't wanted
+        __args.update({"jobs": args_namespace.jobs, "stream": 0})
+        frame_args.append(__args)
+
+    job = {"input": args_namespace.input}
+    FetchJob(job)
+    DecodeJob(job)
+    input_img = job["img"]
+    pixels = PixelArray(input_img)
+    print(f"Rendering {len(frame_args)} frames with seed {frame_args[0]['seed']}...")
+
+    def Frames():
+        planes = {"pixels": pixels}
+        for index in ProgressBars(len(frame_args), "Rendering frames..."):
+            __args = frame_args[index]
+            # masks depend on the frame's args, the other planes only on the pixels
+            __args["planes"] = {
+                key: plane for key, plane in planes.items() if type(key) is not tuple
+            }
+            with open(devnull, "w") as quiet, redirect_stdout(quiet):
+                output_img = RunSort(
+                    input_img,
+                    __args,
+                    ReadIntervalFunction(__args["int_function"]),
+                    ReadSortingFunction(__args["sorting_function"]),
+                    pixels=pixels,
+                )
+            if __args["planes"]["pixels"] is pixels:
+                planes = __args["planes"]
+            __args["planes"] = None
+            yield output_img
+
+    start = perf_counter()
+    count = SaveFrames(Frames(), args_namespace.output, args_namespace.fps)
+    seconds = max(perf_counter() - start, 1e-9)
+    print(
+        f"Rendered {count} frames to {args_namespace.output} in {seconds:.1f} s: "
+        f"{count / seconds:.2f} frames/s."
+    )
 
-    RemoveOld("images/shuffled.png")
-    return pixels
 
+# STREAM #
+def Stream(arguments):
+    r"""
+    Sorts an image too big for memory strip by strip, into a .npy file.
+    A .npy input is memory mapped, so only one strip of -m rows of the source and of the
+    output is in memory at a time. Other images are decoded whole first.
+    No output image is built, the sorted pixels only go to the .npy file.
+    -----
+    :param arguments: command line arguments after "stream".
 
-def none(pixels, args):
-    intervals = []
-    for y in ProgressBars(len(pixels), "Determining intervals..."):
-        Append(intervals, [len(pixels[y])])
-    return intervals
+    Example
+    -----
+    >>> python3 pixelsort.py stream huge.npy sorted.npy --int threshold --sort hue -m 256
+    """
+    parse = ArgParsing()[0]
+    stream = argparse.ArgumentParser(
+        prog="pixelsort.py stream",
+        description="pixel sort a huge image strip by strip into a .npy file",
+        parents=[parse],
+        conflict_handler="resolve",
+    )
+    stream.add_argument(
+        "input", help=".npy file (height, width, 3 or 4) of uint8, or an image file"
+    )
+    stream.add_argument("output", help=".npy file the sorted pixels are written to")
+    stream.add_argument("--int", dest="int_function", default="random")
+    stream.add_argument("--sort", dest="sorting_function", default="lightness")
+    stream.add_argument("-m", "--stream", type=int, help="Rows per strip", default=256)
+    args_namespace = stream.parse_args(arguments)
+    __args = HeadlessArgs(args_namespace)
+    interval_function = ReadIntervalFunction(__args["int_function"])
+    if interval_function.__name__ not in RowFunctions:
+        stream.error(f"--int must be one of {', '.join(RowFunctions)}")
+    if __args["pipeline"] or __args["path"] or __args["roi"] or __args["angle"] % 360:
+        stream.error("-x, -g, -o and -a can't be used when sorting strip by strip")
+    if path.splitext(args_namespace.input)[1].lower() == ".npy":
+        source = npload(args_namespace.input, mmap_mode="r")
+        if source.ndim != 3 or source.shape[2] not in [3, 4]:
+            stream.error(
+                f"{args_namespace.input} isn't of shape (height, width, 3 or 4)"
+            )
+    else:
+        source = Image.open(args_namespace.input)
+    start = perf_counter()
+    StreamSort(
+        source,
+        args_namespace.output,
+        __args,
+        interval_function,
+        ReadSortingFunction(__args["sorting_function"]),
+    )
+    print(f"Sorted in {perf_counter() - start:.1f} s.")
 
 
-# MAIN #
 def main():
     """
     Pixelsorting an image.
@@ -1207,6 +3257,7 @@ def main():
             misc_variables["int_chosen"], int_func_input = (
                 (True, int_func_input)
                 if int_func_input in misc_variables["int_func_options"]
+                or ReadMaskExpression(int_func_input)
                 else (False, "random")
             )
             misc_variables["int_rand"] = False
@@ -1214,9 +3265,8 @@ def main():
             True if int_func_input in ["shuffle-total", "shuffle-axis"] else False
         )
         misc_variables["snapped"] = True if int_func_input in ["snap"] else False
-        misc_variables["file_sorted"] = (
-            True if int_func_input in ["file", "file-edges"] else False
-        )
+        # also true for combinations using file masks
+        misc_variables["file_sorted"] = True if "file" in int_func_input else False
 
         misc_variables["int_msg"] = (
             (
@@ -1256,8 +3306,8 @@ def main():
             misc_variables["sort_rand"] = True
         else:
             misc_variables["sort_chosen"], sort_func_input = (
-                (True, sort_func_input)
-                if sort_func_input in misc_variables["sort_func_options"]
+                (True, sort_func_input.replace(" ", ""))
+                if ValidSortKeys(sort_func_input, misc_variables["sort_func_options"])
                 else (False, "lightness")
             )
             misc_variables["sort_rand"] = False
@@ -1284,6 +3334,7 @@ def main():
             )
             + int_func_input
             if int_func_input in misc_variables["int_func_options"]
+            or ReadMaskExpression(int_func_input)
             else "Interval function: random (default)"
         )
 
@@ -1294,7 +3345,7 @@ def main():
                 else "Sorting function (randomly selected): "
             )
             + sort_func_input
-            if sort_func_input in misc_variables["sort_func_options"]
+            if ValidSortKeys(sort_func_input, misc_variables["sort_func_options"])
             else "Sorting function: lightness (default)"
         )
 
@@ -1313,6 +3364,14 @@ def main():
                 f'{("{:21}".format("Angle"))}{("{:>6}".format("| -a   |"))}Angle at which you\'re pixel sorting in degrees. 0 (horizontal) by default. Takes values from 0-360.\n'
                 f'{("{:21}".format("Threshold (lower)"))}{("{:>6}".format("| -t   |"))}How dark must a pixel be to be considered as a \'border\' for sorting?\n{29 * " "}Takes values from 0-1. 0.25 by default. Used in edges and threshold modes.\n'
                 f'{("{:21}".format("Threshold (upper)"))}{("{:>6}".format("| -u   |"))}How bright must a pixel be to be considered as a \'border\' for sorting?\n{29 * " "}Takes values from 0-1. 0.8 by default. Used in threshold mode.\n'
+                f'{("{:21}".format("Snap fraction"))}{("{:>6}".format("| -f   |"))}What fraction of pixels snap mode makes transparent.\n{29 * " "}Takes values from 0-1. 0.5 by default.\n'
+                f'{("{:21}".format("Path"))}{("{:>6}".format("| -g   |"))}Sort along curves instead of straight lines: circles, spiral, rays or flow.\n{29 * " "}Parameters follow colons, e.g. spiral:30 (pitch) or flow:120:30 (wavelength, amplitude).\n'
+                f'{("{:21}".format("Pipeline"))}{("{:>6}".format("| -x   |"))}Passes run one after another on the same image, separated by |.\n{29 * " "}Each pass is [horizontal/vertical:]interval[:sorting], e.g. vertical:threshold:lightness | horizontal:threshold:hue\n'
+                f'{("{:21}".format("Region"))}{("{:>6}".format("| -o   |"))}Only sort inside a region, the rest of the image is left as is.\n{29 * " "}A rectangle left,top,right,bottom, a polygon x,y;x,y;x,y;... or the path of a mask image (white inside).\n'
+                f'{("{:21}".format("Jobs"))}{("{:>6}".format("| -j   |"))}Number of processes sorting strips of rows, 0 for one per core. 1 by default.\n{29 * " "}Used in threshold, random, waves and none modes at angle 0.\n'
+                f'{("{:21}".format("Stream"))}{("{:>6}".format("| -m   |"))}Sort strips of this many rows one at a time. Off by default. The output image is\n{29 * " "}still built in memory to save it. For images too big for memory use "pixelsort.py stream". Used in threshold, random, waves and none modes at angle 0.\n'
+                f'{("{:21}".format("Time budget"))}{("{:>6}".format("| -w   |"))}Seconds a run may take. Images estimated to take longer are sorted smaller and scaled back up,\n{29 * " "}runs that still take too long are stopped. Off by default.\n'
+                f'{("{:21}".format("Seed"))}{("{:>6}".format("| -e   |"))}Seed for every random choice. Use the same seed to reproduce a run.\n'
             )
         else:
             print(
@@ -1325,6 +3384,14 @@ def main():
                 f'{("{:21}".format("Angle"))}{("{:>6}".format("| -a   |"))}\n'
                 f'{("{:21}".format("Threshold (lower)"))}{("{:>6}".format("| -t   |"))}\n'
                 f'{("{:21}".format("Threshold (upper)"))}{("{:>6}".format("| -u   |"))}\n'
+                f'{("{:21}".format("Snap fraction"))}{("{:>6}".format("| -f   |"))}\n'
+                f'{("{:21}".format("Path"))}{("{:>6}".format("| -g   |"))}\n'
+                f'{("{:21}".format("Pipeline"))}{("{:>6}".format("| -x   |"))}\n'
+                f'{("{:21}".format("Region"))}{("{:>6}".format("| -o   |"))}\n'
+                f'{("{:21}".format("Jobs"))}{("{:>6}".format("| -j   |"))}\n'
+                f'{("{:21}".format("Stream"))}{("{:>6}".format("| -m   |"))}\n'
+                f'{("{:21}".format("Time budget"))}{("{:>6}".format("| -w   |"))}\n'
+                f'{("{:21}".format("Seed"))}{("{:>6}".format("| -e   |"))}\n'
             )
         arg_parse_input = input("\nArgs: ")
         clear()
@@ -1352,7 +3419,7 @@ def main():
     args_full = (
         f" -l {url}"
         f" -i {int_func_input}"
-        f" -s {sort_func_input}"
+        f" --sorting_function={sort_func_input}"
         f" -b {preset_input}"
         f" -p {str(misc_variables['preset_true'])}"
         f" -d {str(db_preset)}"
@@ -1369,8 +3436,18 @@ def main():
         "clength": args_namespace.clength,
         "angle": args_namespace.angle,
         "randomness": args_namespace.randomness,
+        "fraction": args_namespace.fraction,
+        "path": args_namespace.path,
+        "roi": args_namespace.roi,
+        "jobs": args_namespace.jobs,
+        "stream": args_namespace.stream,
+        "budget": args_namespace.budget,
+        "pipeline": (
+            " ".join(args_namespace.pipeline) if args_namespace.pipeline else None
+        ),
+        "seed": args_namespace.seed,
         "url": util_args_namespace.url,
-        "int_function": util_args_namespace.int_function,
+        "int_function": " ".join(util_args_namespace.int_function),
         "sorting_function": util_args_namespace.sorting_function,
         "presetname": util_args_namespace.presetname,
         "filelink": util_args_namespace.filelink,
@@ -1397,62 +3474,35 @@ def main():
     print(f"Upper threshold: {__args['upper_threshold']}") if int_func_input in [
         "threshold"
     ] else None
+    print(f"Snap fraction: {__args['fraction']}") if int_func_input in [
+        "snap"
+    ] else None
     print(f"Characteristic length: {__args['clength']}") if int_func_input in [
         "random",
         "waves",
     ] else None
     print(f"Randomness: {__args['randomness']} %")
     print(f"Angle: {__args['angle']} °")
+    print(f"Path: {__args['path']}") if __args["path"] else None
+    print(f"Pipeline: {__args['pipeline']}") if __args["pipeline"] else None
+    print(f"Region: {__args['roi']}") if __args["roi"] else None
+    print(f"Seed: {__args['seed']}") if __args["seed"] is not None else None
+    print(f"Time budget: {__args['budget']} s") if __args["budget"] else None
     print("------------------------------")
 
-    print("Rotating image...")
-    input_img = input_img.rotate(__args["angle"], expand=True)
-
-    print("Getting data...")
-    data = input_img.load()
-
-    size0, size1 = input_img.size
-    pixels = PixelAppend(size1, size0, data, "Getting pixels...")
-
-    if (
-        misc_variables["shuffled"]
-        or misc_variables["snapped"]
-        or __args["int_function"] in ["snap", "shuffle-total", "shuffle-axis"]
-    ):
-        if misc_variables["snapped"] or __args["int_function"] == "snap":
-            intervals = file_edges(pixels, __args)
-            sorted_pixels = SortImage(pixels, intervals, __args, sorting_function)
-            print(
-                f"{('/' * 45)}\n"
-                f"Dread it. Run from it. Destiny still arrives."
-                f"\n{('/' * 45)}"
-            )
-            thanos_img = Image.new("RGBA", input_img.size)
-            size0, size1 = thanos_img.size
-            for y in ProgressBars(size1, "The end is near..."):
-                for x in range(size0):
-                    ImgPixels(thanos_img, x, y, pixels)
-            thanos_img.save("images/thanos_img.png")
-            print("I am... inevitable...")
-            sorted_pixels = interval_function(sorted_pixels, __args)
-        else:
-            sorted_pixels = interval_function(pixels, __args)
-    else:
-        intervals = interval_function(pixels, __args)
-        sorted_pixels = SortImage(pixels, intervals, __args, sorting_function)
-
-    output_img = Image.new("RGBA", input_img.size)
-    size0, size1 = output_img.size
-    for y in ProgressBars(size1, "Building output image..."):
-        for x in range(size0):
-            ImgPixels(output_img, x, y, sorted_pixels)
-
-    if __args["angle"] != 0:
-        print("Rotating output image back to original orientation...")
-        output_img = output_img.rotate(360 - __args["angle"], expand=True)
-
-        print("Crop image to apropriate size...")
-        output_img = CropTo(output_img, __args)
+    try:
+        output_img = RunSort(
+            input_img,
+            __args,
+            interval_function,
+            sorting_function,
+            misc_variables["shuffled"],
+            misc_variables["snapped"],
+        )
+    except DeadlineExceeded as error:
+        print(f"[WARNING] {error}, nothing was saved.")
+        return
+    print(f"Render path: {__args['render_path']}") if __args["budget"] else None
 
     print("Saving image...")
     output_img.save(output_image_path)
@@ -1465,9 +3515,13 @@ def main():
         )
         print("Image uploaded!")
 
-        if misc_variables["file_sorted"] or (
-            misc_variables["snapped"] and misc_variables["preset_true"]
+        # -x passes replace the chosen interval function, their own file passes make an image
+        if "ca_image" in __args and (
+            misc_variables["file_sorted"]
+            or (misc_variables["snapped"] and misc_variables["preset_true"])
+            or __args["pipeline"]
         ):
+            __args["ca_image"].save("images/ElementaryCA.png")
             file_link, misc_variables["image_upload_failed"] = UploadImg(
                 "images/ElementaryCA.png"
             )
@@ -1522,4 +3576,15 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if argv[1:2] == ["batch"]:
+        Batch(argv[2:])
+    elif argv[1:2] == ["worker"]:
+        Worker(argv[2:])
+    elif argv[1:2] == ["serve"]:
+        Serve(argv[2:])
+    elif argv[1:2] == ["animate"]:
+        Animate(argv[2:])
+    elif argv[1:2] == ["stream"]:
+        Stream(argv[2:])
+    else:
+        main()